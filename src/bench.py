@@ -13,3 +13,438 @@ def repeat_sec(f, n: int) -> float:
     for _ in range(n):
         s += measure_sec(f)
     return s / n
+
+
+def bench_book(n: int = 20000, block: int = 2000):
+    # bookが伸びても1命令あたりの検査時間が一定であることを確かめる。
+    # 旧来のcheck（毎回リストをコピー）とcheck_book（永続ベクタに追記）を比べる
+    from check import Book, check, check_book
+    from inst import SortInst, WeakInst
+
+    insts = [SortInst(0)] + [WeakInst(i, 0, 0, "A") for i in range(1, n)]
+
+    def run(step, book):
+        times: list[float] = []
+        for start in range(0, n, block):
+            tic = time()
+            for inst in insts[start : start + block]:
+                book = step(inst, book)
+            times.append(time() - tic)
+        return times
+
+    old = run(check, [])
+    new = run(check_book, Book())
+    print(f"{'book size':>10} {'check [us/inst]':>16} {'check_book [us/inst]':>21}")
+    for i, (t_old, t_new) in enumerate(zip(old, new)):
+        size = (i + 1) * block
+        print(f"{size:>10} {t_old / block * 1e6:>16.2f} {t_new / block * 1e6:>21.2f}")
+
+
+def bench_nbe(filename: str = "test/def2"):
+    # def2の各定義の本体と型を、素朴な正規化とNbEで正規化して時間を比べる
+    import nbe
+    from check import EMPTY_ENV, normalize
+    from derive import parse_definitions
+    from parse import alpha_eqv
+
+    with open(filename, "r") as f:
+        dfns = parse_definitions(f.readlines())
+    targets = []
+    env = EMPTY_ENV
+    for dfn in dfns:
+        if not dfn.is_prim:
+            targets.append((dfn.body, env))
+        targets.append((dfn.prop, env))
+        env = env.extend(dfn)
+
+    naive = [normalize(t, env) for t, env in targets]
+    evaluated = [nbe.normalize(t, env) for t, env in targets]
+    if not all(alpha_eqv(n1, n2) for n1, n2 in zip(naive, evaluated)):
+        raise Exception("normal forms do not agree")
+
+    def run_naive():
+        for t, env in targets:
+            normalize(t, env)
+
+    def run_nbe():
+        for t, env in targets:
+            nbe.normalize(t, env)
+
+    print(f"{len(targets)} terms in {filename}")
+    print(f"naive: {repeat_sec(run_naive, 5):.4f} sec")
+    print(f"nbe:   {repeat_sec(run_nbe, 5):.4f} sec")
+
+
+def bench_weak(filename: str = "test/def2", limit: int | None = None):
+    # 判断を共有しない導出と共有する導出で、定義から出る命令数を比べる。
+    # limitを渡すと先頭limit個の定義だけを使う。
+    # 共有しないとdef2全体では800万命令を超え、導出に数分かかる
+    import io
+    from contextlib import redirect_stderr
+
+    import derive
+    from inst import OP_WEAK, InstructionArray
+
+    with open(filename, "r") as f:
+        lines = f.readlines()
+    ends = [i for i, line in enumerate(lines) if line.startswith("edef2")]
+    if limit is not None and limit < len(ends):
+        lines = lines[: ends[limit - 1] + 1] + ["END\n"]
+
+    def run(sharing: bool):
+        derive.SHARING = sharing
+        insts = InstructionArray()
+
+        def f():
+            nonlocal insts
+            with redirect_stderr(io.StringIO()):
+                insts = derive.derive_lines(lines)
+
+        sec = measure_sec(f)
+        # 命令のオブジェクトを作らずに、オペコードの列で数える
+        weak = insts.ops.count(OP_WEAK)
+        return len(insts), weak, sec
+
+    results = {"no sharing": run(False), "sharing": run(True)}
+    derive.SHARING = True
+    if limit is None or limit >= len(ends):
+        print(f"all {len(ends)} definitions in {filename}")
+    else:
+        print(f"first {limit} definitions in {filename}")
+    print(f"{'':>10} {'insts':>9} {'weak':>9} {'sec':>8}")
+    for name, (total, weak, sec) in results.items():
+        print(f"{name:>10} {total:>9} {weak:>9} {sec:>8.3f}")
+    (total0, weak0, _), (total1, weak1, _) = results.values()
+    print(f"saved {total0 - total1} insts ({weak0 - weak1} weak)")
+
+
+def bench_binary(filename: str = "test/def2", limit: int = 20):
+    # 同じ命令列をテキスト形式とバイナリ形式で書き、読み込みにかかる時間を比べる。
+    # 大きな命令列にするため、判断を共有しない導出を使う
+    import io
+    import os
+    import tempfile
+    from contextlib import redirect_stderr
+
+    import binfmt
+    import derive
+
+    with open(filename, "r") as f:
+        lines = f.readlines()
+    ends = [i for i, line in enumerate(lines) if line.startswith("edef2")]
+    if limit < len(ends):
+        lines = lines[: ends[limit - 1] + 1] + ["END\n"]
+    derive.SHARING = False
+    with redirect_stderr(io.StringIO()):
+        insts = derive.derive_lines(lines)
+    derive.SHARING = True
+
+    with tempfile.TemporaryDirectory() as d:
+        text = os.path.join(d, "insts")
+        binary = os.path.join(d, "insts.bin")
+        with open(text, "w") as f:
+            for inst in insts:
+                print(inst, file=f)
+        with open(binary, "wb") as f:
+            binfmt.write_binary(insts, f)
+        if list(binfmt.read_binary(binary)) != list(binfmt.read_text(text)):
+            raise Exception("formats do not agree")
+        print(f"{len(insts)} insts")
+        print(f"{'':>7} {'bytes':>9} {'load [sec]':>11}")
+        for name, path, read in [
+            ("text", text, binfmt.read_text),
+            ("binary", binary, binfmt.read_binary),
+        ]:
+            sec = repeat_sec(lambda: list(read(path)), 5)
+            print(f"{name:>7} {os.path.getsize(path):>9} {sec:>11.4f}")
+
+
+def bench_deep(
+    depths: tuple[int, ...] = (1000, 10000, 100000), book_limit: int = 10000
+):
+    # 深い項（関数適用の鎖、入れ子のΠ型、βで潰れるλの鎖）で、項の基本操作の時間を
+    # 明示的なスタックで書いた今の実装と、再帰で書いた以前の実装（recursive_*）で比べる。
+    # 定数の展開は、適用の鎖を引数にした定義idt（idt := x）で、素朴な正規化とNbEで測る。
+    # 再帰の深さの上限に当たった場合はRecursionErrorと表示する。
+    # 導出と検査は深さbook_limitまでの定義で測る。本体が適用の鎖のもの（def2の本から導出）と、
+    # 入れ子のλのもの（束縛変数名は1文字なので、項を直接作ってprove_defで導出）の二つ。
+    # 導出には再帰で書いた実装を残していないので、比べない
+    import io
+    from contextlib import redirect_stderr
+
+    import nbe
+    from check import EMPTY_ENV, Book, Context, Definition, check_book, normalize
+    from derive import derive_lines, prove_def
+    from fresh_name import Fresh
+    from inst import EndInst, InstructionArray, SortInst
+    from parse import AppTerm, ConstTerm, LambdaTerm, PiTerm, StarTerm, Term, VarTerm
+    from parse import alpha_with_env_depth, parse_term
+    from subst import rename, subst
+
+    # 再帰で書いた以前の実装。定数はidtの展開でだけ使うので、
+    # recursive_normalizeのほかは定数の場合を省いている
+    def recursive_str(t) -> str:
+        if isinstance(t, AppTerm):
+            return f"%({recursive_str(t.t1)})({recursive_str(t.t2)})"
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            head = "$" if isinstance(t, LambdaTerm) else "?"
+            t1 = recursive_str(t.t1)
+            t2 = recursive_str(t.t2)
+            return f"{head}{t.name}:({t1}).({t2})"
+        return str(t)
+
+    def recursive_alpha(t1, t2, env1: dict[str, int], env2: dict[str, int], d: int):
+        # 束縛子ごとに環境をコピーする
+        if type(t1) != type(t2):
+            return False
+        if isinstance(t1, VarTerm):
+            d1 = env1.get(t1.name)
+            d2 = env2.get(t2.name)
+            if d1 is None and d2 is None:
+                return t1.name == t2.name
+            return d1 == d2
+        elif isinstance(t1, LambdaTerm) or isinstance(t1, PiTerm):
+            if not recursive_alpha(t1.t1, t2.t1, env1, env2, d):
+                return False
+            envc1 = env1.copy()
+            envc2 = env2.copy()
+            envc1[t1.name] = d
+            envc2[t2.name] = d
+            return recursive_alpha(t1.t2, t2.t2, envc1, envc2, d + 1)
+        elif isinstance(t1, AppTerm):
+            return recursive_alpha(
+                t1.t1, t2.t1, env1, env2, d
+            ) and recursive_alpha(t1.t2, t2.t2, env1, env2, d)
+        return True
+
+    def recursive_rename(t, frm: str, to: str):
+        if isinstance(t, VarTerm):
+            return VarTerm(to) if t.name == frm else t
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            t1 = recursive_rename(t.t1, frm, to)
+            t2 = t.t2 if t.name == frm else recursive_rename(t.t2, frm, to)
+            return type(t)(t1, t2, t.name)
+        elif isinstance(t, AppTerm):
+            return AppTerm(
+                recursive_rename(t.t1, frm, to), recursive_rename(t.t2, frm, to)
+            )
+        return t
+
+    def recursive_subst(t1, t2, name: str):
+        if isinstance(t1, VarTerm):
+            return t2 if t1.name == name else t1
+        elif isinstance(t1, LambdaTerm) or isinstance(t1, PiTerm):
+            t11 = recursive_subst(t1.t1, t2, name)
+            if t1.name == name:
+                return type(t1)(t11, t1.t2, name)
+            fresh_name = Fresh.fresh()
+            t12 = recursive_rename(t1.t2, t1.name, fresh_name)
+            return type(t1)(t11, recursive_subst(t12, t2, name), fresh_name)
+        elif isinstance(t1, AppTerm):
+            return AppTerm(
+                recursive_subst(t1.t1, t2, name), recursive_subst(t1.t2, t2, name)
+            )
+        return t1
+
+    def recursive_normalize(t, env=EMPTY_ENV):
+        if isinstance(t, AppTerm):
+            t1 = recursive_normalize(t.t1, env)
+            t2 = recursive_normalize(t.t2, env)
+            if isinstance(t1, LambdaTerm):
+                fresh_name = Fresh.fresh()
+                escaped = recursive_rename(t2, t1.name, fresh_name)
+                body = recursive_subst(t1.t2, escaped, t1.name)
+                return recursive_normalize(body, env)
+            return AppTerm(t1, t2)
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            t1 = recursive_normalize(t.t1, env)
+            return type(t)(t1, recursive_normalize(t.t2, env), t.name)
+        elif isinstance(t, ConstTerm):
+            # パラメタが一つの定義だけを展開する
+            args = [recursive_normalize(tt, env) for tt in t.children]
+            dfn = env.lookup(t.op)[1]
+            body = recursive_subst(dfn.body, args[0], dfn.names[0])
+            return recursive_normalize(body, env)
+        return t
+
+    a = VarTerm("a")
+    f = VarTerm("f")
+    A = VarTerm("A")
+
+    def app_chain(n: int) -> Term:
+        # %(f)(%(f)(...%(f)(a)))
+        t: Term = a
+        for _ in range(n):
+            t = AppTerm(f, t)
+        return t
+
+    def binder_chain(n: int, prefix: str, kind: type, inner: Term) -> Term:
+        # ?x0:(A).(?x1:(A).(...(inner)))
+        t = inner
+        for i in reversed(range(n)):
+            t = kind(A, t, f"{prefix}{i}")
+        return t
+
+    # idt := x（文脈 x:*）だけを定義した環境
+    idt = Definition("idt", Context([("x", StarTerm())]), VarTerm("x"), StarTerm())
+    idt_env = EMPTY_ENV.extend(idt)
+
+    def redex_chain(n: int) -> Term:
+        # %($x:(*).(x))(%($x:(*).(x))(...a))。正規化するとaになる
+        identity = LambdaTerm(StarTerm(), VarTerm("x"), "x")
+        t: Term = a
+        for _ in range(n):
+            t = AppTerm(identity, t)
+        return t
+
+    def book(body: str) -> list[str]:
+        # 文脈 A:*, f:?x:(A).(A), a:A のもとで、bodyを本体に持つ定義
+        lines = ["def2", "3", "A", "*", "f", "?x:(A).(A)", "a", "A"]
+        lines += ["deep", body, "A", "edef2", "END"]
+        return [line + "\n" for line in lines]
+
+    def check_all(insts: InstructionArray):
+        b = Book()
+        for inst in insts:
+            b = check_book(inst, b)
+
+    def derive_check(lines: list[str]):
+        with redirect_stderr(io.StringIO()):
+            check_all(derive_lines(lines))
+
+    def derive_check_def(dfn: Definition):
+        insts = InstructionArray([SortInst(0)])
+        prove_def(dfn, EMPTY_ENV, insts)
+        insts.append(EndInst(-1))
+        check_all(insts)
+
+    def attempt(op) -> str:
+        if op is None:
+            return "-"
+        try:
+            return f"{measure_sec(op):.4f}"
+        except RecursionError:
+            return "RecursionError"
+
+    print(
+        f"{'depth':>7} {'operation':>15} "
+        f"{'iterative [sec]':>16} {'recursive [sec]':>16}"
+    )
+    for n in depths:
+        apps = app_chain(n)
+        pis1 = binder_chain(n, "x", PiTerm, A)
+        pis2 = binder_chain(n, "y", PiTerm, A)
+        redexes = redex_chain(n)
+        unfold = ConstTerm("idt", [apps])
+        # 適用の鎖を文字列で。strを使わないので、再帰で書いたstrでも作れる
+        text = "%(f)(" * n + "a" + ")" * n
+        b = VarTerm("b")
+        # 操作の名前から（今の実装, 再帰で書いた実装）
+        ops = {
+            "str": (lambda: str(apps), lambda: recursive_str(apps)),
+            "parse": (lambda: parse_term(text), None),
+            "alpha": (
+                lambda: alpha_with_env_depth(pis1, pis2, {}, {}, 0),
+                lambda: recursive_alpha(pis1, pis2, {}, {}, 0),
+            ),
+            "subst": (
+                lambda: subst(apps, b, "a"),
+                lambda: recursive_subst(apps, b, "a"),
+            ),
+            "rename": (
+                lambda: rename(pis1, "A", "B"),
+                lambda: recursive_rename(pis1, "A", "B"),
+            ),
+            "normalize": (
+                lambda: normalize(redexes, EMPTY_ENV),
+                lambda: recursive_normalize(redexes),
+            ),
+            "normalize δ": (
+                lambda: normalize(unfold, idt_env),
+                lambda: recursive_normalize(unfold, idt_env),
+            ),
+            "nbe δ": (lambda: nbe.normalize(unfold, idt_env), None),
+        }
+        if n <= book_limit:
+            lines = book(text)
+            lambdas = Definition(
+                "deep",
+                Context([("A", StarTerm()), ("a", A)]),
+                binder_chain(n, "x", LambdaTerm, a),
+                binder_chain(n, "x", PiTerm, A),
+            )
+            ops["derive+check"] = (lambda: derive_check(lines), None)
+            ops["derive+check λ"] = (lambda: derive_check_def(lambdas), None)
+        for name, (iterative, recursive) in ops.items():
+            print(
+                f"{n:>7} {name:>15} "
+                f"{attempt(iterative):>16} {attempt(recursive):>16}"
+            )
+
+
+def bench_alpha(sizes: tuple[int, ...] = (100, 1000, 10000), n: int = 5):
+    # test/in-alpha*の各組を、束縛子の鎖で包んで大きくした項でα同値性の判定の時間を測る。
+    # 鎖の束縛変数名は左右で変え（x0, x1, ... とy0, y1, ...）、各束縛子の本体で
+    # その変数を使うので、同一性では判定できず、環境を引きながら全体をたどることになる。
+    # 構造をたどる判定（alpha_with_env_depth）と、両辺のShapeを作って比べる判定を比べる
+    import glob
+    import os
+
+    from parse import AppTerm, PiTerm, StarTerm, Term, VarTerm
+    from parse import alpha_with_env_depth, parse_term, shape_with_env_depth
+
+    def scale(t: Term, size: int, prefix: str) -> Term:
+        # ?p0:(*).(?p1:(p0).(...%(...%(t)(p0)...)(p{size-1})))
+        body = t
+        for i in range(size):
+            body = AppTerm(body, VarTerm(f"{prefix}{i}"))
+        for i in reversed(range(size)):
+            tp = StarTerm() if i == 0 else VarTerm(f"{prefix}{i - 1}")
+            body = PiTerm(tp, body, f"{prefix}{i}")
+        return body
+
+    print(
+        f"{'case':>10} {'size':>6} {'eqv':>6} {'walk [sec]':>11} {'shape [sec]':>12}"
+    )
+    for filename in sorted(glob.glob("test/in-alpha*")):
+        with open(filename, "r") as f:
+            t1, t2 = [parse_term(line.strip()) for line in f if line.strip()]
+        expected = alpha_with_env_depth(t1, t2, {}, {}, 0)
+        for size in sizes:
+            u1 = scale(t1, size, "x")
+            u2 = scale(t2, size, "y")
+            if alpha_with_env_depth(u1, u2, {}, {}, 0) != expected:
+                raise Exception(f"scaled case disagrees: {filename}")
+
+            def walk():
+                alpha_with_env_depth(u1, u2, {}, {}, 0)
+
+            def shape():
+                _ = shape_with_env_depth(u1, {}, 0) is shape_with_env_depth(u2, {}, 0)
+
+            name = os.path.basename(filename)
+            walk_sec = repeat_sec(walk, n)
+            shape_sec = repeat_sec(shape, n)
+            print(
+                f"{name:>10} {size:>6} {expected!s:>6} "
+                f"{walk_sec:>11.4f} {shape_sec:>12.4f}"
+            )
+
+
+BENCHES = {
+    "book": bench_book,
+    "nbe": bench_nbe,
+    "weak": bench_weak,
+    "binary": bench_binary,
+    "deep": bench_deep,
+    "alpha": bench_alpha,
+}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    apaser = argparse.ArgumentParser(prog="bench")
+    apaser.add_argument("name", choices=BENCHES.keys())
+    args = apaser.parse_args()
+    BENCHES[args.name]()
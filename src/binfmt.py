@@ -0,0 +1,284 @@
+# binfmt.py
+# 命令列のバイナリ形式と、テキスト形式との相互変換を定義する
+#
+# 形式
+#   MAGIC（8バイト）
+#   名前表: 名前の数、続いて各名前の（UTF-8でのバイト数、バイト列）
+#   命令: ファイルの終わりまで、オペコードとオペランド（行番号、前提の番号など）の並び
+# 整数はすべてzigzag符号化したLEB128（7ビットずつ、下位から）で書く。
+# オペコードは64未満なので、常に1バイトになる。
+# 変数名と定数名は名前表での番号で書くので、命令を読むときに文字列を解析しない。
+
+import mmap
+from typing import BinaryIO, Iterable, Iterator
+
+from fresh_name import Fresh
+from inst import (
+    OP_ABST,
+    OP_APPL,
+    OP_CONV,
+    OP_CP,
+    OP_DEF,
+    OP_DEFPR,
+    OP_END,
+    OP_FORM,
+    OP_INST,
+    OP_SORT,
+    OP_SP,
+    OP_VAR,
+    OP_WEAK,
+    AbstInst,
+    ApplInst,
+    ConvInst,
+    CPInst,
+    DefInst,
+    DefPrInst,
+    EndInst,
+    FormInst,
+    InstInst,
+    Instruction,
+    InstructionArray,
+    SortInst,
+    SPInst,
+    VarInst,
+    WeakInst,
+    scan_inst,
+)
+from parse import VarTerm
+
+MAGIC = b"VRFYINS\x01"
+
+
+class BinaryFormatError(Exception):
+    pass
+
+
+def is_binary(filename: str) -> bool:
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def encode_int(n: int, out: bytearray):
+    z = n * 2 if n >= 0 else -n * 2 - 1
+    while z >= 0x80:
+        out.append((z & 0x7F) | 0x80)
+        z >>= 7
+    out.append(z)
+
+
+def instruction_names(inst: Instruction) -> list[str]:
+    match inst:
+        case VarInst(_lnum, _pre, var):
+            return [var.name]
+        case WeakInst(_lnum, _pre1, _pre2, var):
+            return [var]
+        case DefInst(_lnum, _pre1, _pre2, op) | DefPrInst(_lnum, _pre1, _pre2, op):
+            return [op]
+        case _:
+            return []
+
+
+def encode_inst(inst: Instruction, name_ids: dict[str, int], out: bytearray):
+    def ints(op: int, *ns: int):
+        encode_int(op, out)
+        encode_int(inst.lnum, out)
+        for n in ns:
+            encode_int(n, out)
+
+    match inst:
+        case SortInst(_lnum):
+            ints(OP_SORT)
+        case EndInst(_lnum):
+            ints(OP_END)
+        case VarInst(_lnum, pre, var):
+            ints(OP_VAR, pre, name_ids[var.name])
+        case WeakInst(_lnum, pre1, pre2, var):
+            ints(OP_WEAK, pre1, pre2, name_ids[var])
+        case FormInst(_lnum, pre1, pre2):
+            ints(OP_FORM, pre1, pre2)
+        case ApplInst(_lnum, pre1, pre2):
+            ints(OP_APPL, pre1, pre2)
+        case AbstInst(_lnum, pre1, pre2):
+            ints(OP_ABST, pre1, pre2)
+        case ConvInst(_lnum, pre1, pre2):
+            ints(OP_CONV, pre1, pre2)
+        case DefInst(_lnum, pre1, pre2, op):
+            ints(OP_DEF, pre1, pre2, name_ids[op])
+        case DefPrInst(_lnum, pre1, pre2, op):
+            ints(OP_DEFPR, pre1, pre2, name_ids[op])
+        case InstInst(_lnum, pre, length, pres, op_offset):
+            ints(OP_INST, pre, length, len(pres), *pres, op_offset)
+        case CPInst(_lnum, target):
+            ints(OP_CP, target)
+        case SPInst(_lnum, target, bind):
+            ints(OP_SP, target, bind)
+        case _:
+            raise BinaryFormatError(f"cannot encode: {inst}")
+
+
+def write_binary(insts: Iterable[Instruction], f: BinaryIO):
+    # InstructionArrayなら、その名前表をそのまま使う
+    if isinstance(insts, InstructionArray):
+        names = insts.names
+        name_ids = insts.name_ids
+    else:
+        insts = list(insts)
+        names = []
+        name_ids = {}
+        for inst in insts:
+            for name in instruction_names(inst):
+                if name not in name_ids:
+                    name_ids[name] = len(names)
+                    names.append(name)
+    out = bytearray(MAGIC)
+    encode_int(len(names), out)
+    for name in names:
+        bs = name.encode("utf-8")
+        encode_int(len(bs), out)
+        out += bs
+    for inst in insts:
+        encode_inst(inst, name_ids, out)
+    f.write(out)
+
+
+def read_int(buf: bytes | mmap.mmap, pos: int) -> tuple[int, int]:
+    # bufのposから整数を一つ読み、その値と次の位置を返す
+    z = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise BinaryFormatError(f"unexpected end of data at {pos}")
+        b = buf[pos]
+        pos += 1
+        z |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (z >> 1) ^ -(z & 1), pos
+        shift += 7
+
+
+def varints(data: Iterable[int]) -> Iterator[int]:
+    # バイトの列を整数の列として読む
+    z = 0
+    shift = 0
+    for b in data:
+        if b < 0x80:
+            z |= b << shift
+            yield (z >> 1) ^ -(z & 1)
+            z = 0
+            shift = 0
+        else:
+            z |= (b & 0x7F) << shift
+            shift += 7
+    if shift:
+        raise BinaryFormatError("unexpected end of data")
+
+
+def decode(buf: bytes | mmap.mmap) -> Iterator[Instruction]:
+    # bufの先頭からMAGIC、名前表、命令の順に読む。
+    # 命令の部分はオペコードも含めて整数の列なので、まとめて整数の列として読む
+    if buf[: len(MAGIC)] != MAGIC:
+        raise BinaryFormatError("bad magic header")
+    pos = len(MAGIC)
+    names: list[str] = []
+    count, pos = read_int(buf, pos)
+    for _ in range(count):
+        size, pos = read_int(buf, pos)
+        names.append(bytes(buf[pos : pos + size]).decode("utf-8"))
+        pos += size
+    # 名前表の^Nより先に、このプロセスで生成するフレッシュな名前の番号を進めておく
+    for name in names:
+        Fresh.reserve(name)
+
+    with memoryview(buf)[pos:] as view:
+        ints = varints(view)
+        read = ints.__next__
+        for op in ints:
+            try:
+                lnum = read()
+                if op == OP_SORT:
+                    yield SortInst(lnum)
+                elif op == OP_END:
+                    yield EndInst(lnum)
+                elif op == OP_VAR:
+                    pre = read()
+                    yield VarInst(lnum, pre, VarTerm(names[read()]))
+                elif op == OP_WEAK:
+                    pre1 = read()
+                    pre2 = read()
+                    yield WeakInst(lnum, pre1, pre2, names[read()])
+                elif op == OP_FORM:
+                    yield FormInst(lnum, read(), read())
+                elif op == OP_APPL:
+                    yield ApplInst(lnum, read(), read())
+                elif op == OP_ABST:
+                    yield AbstInst(lnum, read(), read())
+                elif op == OP_CONV:
+                    yield ConvInst(lnum, read(), read())
+                elif op == OP_DEF:
+                    pre1 = read()
+                    pre2 = read()
+                    yield DefInst(lnum, pre1, pre2, names[read()])
+                elif op == OP_DEFPR:
+                    pre1 = read()
+                    pre2 = read()
+                    yield DefPrInst(lnum, pre1, pre2, names[read()])
+                elif op == OP_INST:
+                    pre = read()
+                    length = read()
+                    pres = [read() for _ in range(read())]
+                    yield InstInst(lnum, pre, length, pres, read())
+                elif op == OP_CP:
+                    yield CPInst(lnum, read())
+                elif op == OP_SP:
+                    yield SPInst(lnum, read(), read())
+                else:
+                    raise BinaryFormatError(f"unknown opcode {op}")
+            except StopIteration:
+                raise BinaryFormatError("unexpected end of data")
+
+
+def read_binary(filename: str) -> Iterator[Instruction]:
+    # ファイルをメモリマップして、命令を一つずつ読む
+    with open(filename, "rb") as f:
+        if f.seek(0, 2) == 0:
+            raise BinaryFormatError("empty file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield from decode(buf)
+
+
+def read_text(filename: str) -> Iterator[Instruction]:
+    with open(filename, "r") as f:
+        for line in f:
+            yield scan_inst(line.replace("\n", ""))
+
+
+def read_insts(filename: str) -> Iterator[Instruction]:
+    # テキスト形式でもバイナリ形式でも読む（先頭のMAGICで見分ける）
+    if is_binary(filename):
+        return read_binary(filename)
+    return read_text(filename)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    apaser = argparse.ArgumentParser(prog="binfmt")
+    apaser.add_argument("direction", choices=["to-binary", "to-text"])
+    apaser.add_argument("input")
+    apaser.add_argument("output", nargs="?", help="省略すると標準出力に書く")
+    args = apaser.parse_args()
+
+    insts = read_insts(args.input)
+    if args.direction == "to-binary":
+        if args.output is None:
+            write_binary(insts, sys.stdout.buffer)
+        else:
+            with open(args.output, "wb") as f:
+                write_binary(insts, f)
+    else:
+        out = sys.stdout if args.output is None else open(args.output, "w")
+        for inst in insts:
+            print(inst, file=out)
+        if out is not sys.stdout:
+            out.close()
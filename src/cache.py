@@ -0,0 +1,201 @@
+# cache.py
+# 導出した命令の断片と検査の結果を、内容から求めた鍵でディスクに保存するキャッシュ
+#
+# 鍵は、結果を決める入力をすべて文字列にしてSHA-256で要約したもの。
+# - 導出の断片: 定義の内容と、参照する定数の環境での位置と鍵。
+#   定数の鍵はその定数が参照する定数の鍵を含むので、ある定義を書き換えると、
+#   それを（間接的にでも）参照する定義の鍵もすべて変わる。
+# - 検査の結果: 区間の命令（区間の外の判断を参照する番号は付け替える）と、
+#   区間の外から参照する判断の内容（環境も含む）。
+# 項は束縛変数名を忘れた形で文字列にするので、フレッシュな名前の番号が変わっても鍵は変わらない。
+#
+# 保存の形式
+#   DIRECTORY/derive/鍵: 断片をbinfmtのバイナリ形式で
+#   DIRECTORY/check/鍵: 検査に通った区間の印（空のファイル）
+
+import hashlib
+import io
+import os
+import tempfile
+from typing import TYPE_CHECKING, Iterable, Sequence
+
+import binfmt
+from inst import Instruction, InstructionArray, renumber
+from parse import (
+    AppTerm,
+    ConstTerm,
+    LambdaTerm,
+    PiTerm,
+    SortTerm,
+    StarTerm,
+    Term,
+    UnExpectedTermError,
+    VarTerm,
+)
+
+if TYPE_CHECKING:
+    from check import Definition, Environment, Judgement
+
+# 鍵の作り方や保存の形式を変えたら上げる
+FORMAT = "1"
+
+
+def digest(parts: Iterable[str]) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def term_text(t: Term) -> str:
+    # 束縛変数名を忘れた形を前置記法で書いた文字列。α同値な項で一致する。
+    # 束縛変数は何個内側の束縛子で束縛されているか（de Bruijn index）で書く。
+    # 深い項でも再帰しないように、明示的なスタックでたどる。boundは束縛変数名から
+    # それを束縛した深さへの写像で、束縛子の本体をたどるあいだだけ書き換える。
+    # スタックの各要素は（部分項, 段階, 深さ, 覆い隠した束縛の深さ）
+    tokens: list[str] = []
+    bound: dict[str, int] = {}
+    stack: list[tuple[Term, int, int, int | None]] = [(t, 0, 0, None)]
+    while stack:
+        t, stage, depth, shadowed = stack.pop()
+        if isinstance(t, VarTerm):
+            d = bound.get(t.name)
+            tokens.append(t.name if d is None else f"#{depth - d - 1}")
+        elif isinstance(t, StarTerm):
+            tokens.append("*")
+        elif isinstance(t, SortTerm):
+            tokens.append("@")
+        elif isinstance(t, AppTerm):
+            tokens.append("%")
+            stack.append((t.t2, 0, depth, None))
+            stack.append((t.t1, 0, depth, None))
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            if stage == 0:
+                tokens.append("$" if isinstance(t, LambdaTerm) else "?")
+                stack.append((t, 1, depth, None))
+                stack.append((t.t1, 0, depth, None))
+            elif stage == 1:
+                stack.append((t, 2, depth, bound.get(t.name)))
+                bound[t.name] = depth
+                stack.append((t.t2, 0, depth + 1, None))
+            elif shadowed is None:
+                del bound[t.name]
+            else:
+                bound[t.name] = shadowed
+        elif isinstance(t, ConstTerm):
+            tokens.append(f"{t.op}[{len(t.children)}")
+            stack += [(tt, 0, depth, None) for tt in reversed(t.children)]
+        else:
+            raise UnExpectedTermError(t)
+    return " ".join(tokens)
+
+
+def definition_key(dfn: "Definition") -> str:
+    parts = [dfn.op, "prim" if dfn.is_prim else "def"]
+    for name, tp in dfn.context.bindings():
+        parts += [name, term_text(tp)]
+    parts += [":=", "" if dfn.is_prim else term_text(dfn.body), term_text(dfn.prop)]
+    return digest(parts)
+
+
+class ResultCache:
+    """
+    内容で引くディスク上のキャッシュ。
+    hits、missesは引いた回数、storesは保存した回数。
+    環境の鍵は、環境を伸ばすたびに親の鍵と定義の鍵から求めて覚えておく。
+    環境のidが使い回されないように、覚えた鍵と一緒に環境も持っておく。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.env_keys: dict[int, tuple["Environment", str]] = {}
+
+    def path(self, kind: str, key: str) -> str:
+        return os.path.join(self.directory, kind, key)
+
+    def _write(self, path: str, data: bytes):
+        # 書きかけのファイルを読まないように、一時ファイルに書いてから置き換える
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.stores += 1
+
+    def get_fragment(self, key: str) -> InstructionArray | None:
+        # 断片は前のプロセスがつけたフレッシュな名前（^N）を持つ。読むときにbinfmt.decodeが
+        # Fresh.reserveで番号をその先に進めるので、このプロセスで生成する名前とは衝突しない
+        path = self.path("derive", key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            fragment = InstructionArray(binfmt.read_binary(path))
+        except binfmt.BinaryFormatError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fragment
+
+    def put_fragment(self, key: str, fragment: InstructionArray):
+        buf = io.BytesIO()
+        binfmt.write_binary(fragment, buf)
+        self._write(self.path("derive", key), buf.getvalue())
+
+    def is_checked(self, key: str) -> bool:
+        if os.path.exists(self.path("check", key)):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def put_checked(self, key: str):
+        self._write(self.path("check", key), b"")
+
+    def env_key(self, env: "Environment") -> str:
+        uncached: list[Environment] = []
+        e: Environment | None = env
+        while e is not None and id(e) not in self.env_keys:
+            uncached.append(e)
+            e = e.parent
+        key = digest([FORMAT]) if e is None else self.env_keys[id(e)][1]
+        for e in reversed(uncached):
+            if e.definition is not None:
+                key = digest([key, definition_key(e.definition)])
+            self.env_keys[id(e)] = (e, key)
+        return key
+
+    def judgement_key(self, j: "Judgement") -> str:
+        parts = [self.env_key(j.environment)]
+        for name, tp in j.context.bindings():
+            parts += [name, term_text(tp)]
+        parts += ["|-", term_text(j.proof), term_text(j.prop)]
+        return digest(parts)
+
+    def segment_key(
+        self,
+        insts: Sequence[Instruction],
+        size: int,
+        imported: dict[int, "Judgement"],
+    ) -> str:
+        # sizeは区間の前の判断の数。区間の中の判断はsizeを引いた番号に、
+        # 区間の外から参照する判断は（-1から数えた）参照する判断の中での順番に付け替える
+        order = {i: k for k, i in enumerate(sorted(imported))}
+
+        def local(i: int) -> int:
+            return -1 - order[i] if i in order else i - size
+
+        parts = [FORMAT]
+        parts += [self.judgement_key(imported[i]) for i in sorted(imported)]
+        parts += [str(renumber(inst, local)) for inst in insts]
+        return digest(parts)
+
+    def __str__(self) -> str:
+        return (
+            f"result cache ({self.directory}): {self.hits} hits, "
+            f"{self.misses} misses, {self.stores} stores"
+        )
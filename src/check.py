@@ -1,9 +1,17 @@
+import argparse
+import bisect
 import functools
+import sys
+import weakref
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from dataclasses import dataclass
-from typing import Tuple
+from typing import TYPE_CHECKING, Iterable, Iterator, Sequence, Tuple
 
+import trampoline
 from fresh_name import Fresh
 from inst import (
+    OP_END,
     AbstInst,
     ApplInst,
     ConvInst,
@@ -14,11 +22,15 @@ from inst import (
     FormInst,
     InstInst,
     Instruction,
+    InstructionArray,
     SortInst,
     SPInst,
     VarInst,
     WeakInst,
-    scan_inst,
+    last_uses,
+    premises,
+    release_schedule,
+    scan_premises,
 )
 from parse import (
     AppTerm,
@@ -32,87 +44,235 @@ from parse import (
     alpha_eqv,
     parse_term,
 )
-from subst import rename, subst, subst_all
+import binfmt
+import nameless
+import nbe
+import subst as substitution
+from pvector import PVector
+from trampoline import Step
+from subst import rename, subst, subst_all, subst_many
+
+if TYPE_CHECKING:
+    from cache import ResultCache
+
+
+class _NameIndex:
+    """
+    変数名から、文脈の束縛の位置への索引。
+    _OpIndexと同じく、文脈の列（親と子）で一つの索引を共有し、
+    各文脈は位置が自分の長さ未満の項目だけを見る。
+    positions[name]はnameを束縛する位置の昇順のリスト、tps[i]は位置iの束縛の型。
+    sizeはこの索引を使う一番長い文脈の長さで、その文脈を伸ばすときは書き足すだけで済む。
+    古い文脈を伸ばす（分岐する）ときだけ、見える項目をコピーする。
+    """
+
+    __slots__ = ("positions", "tps", "size")
+
+    def __init__(
+        self,
+        positions: dict[str, list[int]] | None = None,
+        tps: list[Term] | None = None,
+        size: int = 0,
+    ):
+        self.positions: dict[str, list[int]] = {} if positions is None else positions
+        self.tps: list[Term] = [] if tps is None else tps
+        self.size = size
+
+    def extended(self, size: int, name: str, tp: Term) -> "_NameIndex":
+        # 長さsizeの文脈の索引に、位置sizeの束縛name:tpを書き足した索引
+        index = self
+        if self.size != size:
+            positions: dict[str, list[int]] = {}
+            for n, ps in self.positions.items():
+                visible = ps[: bisect.bisect_left(ps, size)]
+                if visible:
+                    positions[n] = visible
+            index = _NameIndex(positions, self.tps[:size], size)
+        index.positions.setdefault(name, []).append(size)
+        index.tps.append(tp)
+        index.size = size + 1
+        return index
+
+    def get(self, size: int, name: str) -> Term | None:
+        # 長さsizeの文脈で、nameの一番内側の束縛の型
+        ps = self.positions.get(name)
+        if ps is None:
+            return None
+        k = bisect.bisect_left(ps, size)
+        return None if k == 0 else self.tps[ps[k - 1]]
 
 
-@dataclass(frozen=True)
 class Context:
-    container: list[Tuple[str, Term]]
-
-    def extend(self, var: str, t: Term):
-        lst = self.container.copy()
-        lst.append((var, t))
-        return Context(lst)
+    """
+    文脈（変数とその型の列）。
+    永続的な連結リストで、各Contextは親（最後の束縛を除いた文脈）と最後の束縛だけを持つ。
+    extend、cdr、carは定数時間で、伸ばす前の文脈とは接頭辞を共有する。
+    同じ文脈を同じ名前と同一の型で伸ばすと同じオブジェクトが返る（intern）。
+    Context(束縛のリスト)でも作れる。
+    """
+
+    __slots__ = (
+        "parent",
+        "name",
+        "tp",
+        "size",
+        "_children",
+        "_index",
+        "_names_tps",
+        "_hash",
+        "__weakref__",
+    )
+
+    # __eq__の統計。identical: 同一だった、rejected: 長さかハッシュで不一致とわかった、
+    # walked: 共通の祖先まで遡った、compared: 遡るときに比べた束縛の数
+    eq_stats = {"identical": 0, "rejected": 0, "walked": 0, "compared": 0}
+
+    parent: "Context | None"
+    name: str
+    tp: Term
+    size: int
+
+    def __new__(cls, container: Iterable[Tuple[str, Term]] = ()) -> "Context":
+        ctx = EMPTY_CTX
+        for name, tp in container:
+            ctx = ctx.extend(name, tp)
+        return ctx
+
+    @classmethod
+    def _make(cls, parent: "Context | None", name: str, tp: Term) -> "Context":
+        ctx = object.__new__(cls)
+        ctx.parent = parent
+        ctx.name = name
+        ctx.tp = tp
+        ctx.size = 0 if parent is None else parent.size + 1
+        ctx._children = weakref.WeakValueDictionary()
+        ctx._index = _NameIndex() if parent is None else None
+        ctx._names_tps = None
+        ctx._hash = None
+        return ctx
+
+    def extend(self, var: str, t: Term) -> "Context":
+        # 型はハッシュコンシングされているので、idで区別すれば十分。
+        # 子が生きている間は型も生きているので、idが使い回されることはない
+        key = (var, id(t))
+        child = self._children.get(key)
+        if child is None:
+            child = Context._make(self, var, t)
+            self._children[key] = child
+        return child
 
     def get(self, name: str) -> Term | None:
-        return next((b[1] for b in self.container if b[0] == name), None)
-
-    @property
-    def size(self):
-        return len(self.container)
+        # 一番内側の束縛の型を返す
+        return self.name_index().get(self.size, name)
+
+    def name_index(self) -> _NameIndex:
+        # 索引を持つ祖先まで遡り、そこから順に索引を伸ばして持たせる
+        if self._index is None:
+            uncached: list[Context] = []
+            c: Context | None = self
+            while c is not None and c._index is None:
+                uncached.append(c)
+                c = c.parent
+            index = _NameIndex() if c is None else c._index
+            for c in reversed(uncached):
+                index = index.extended(c.size - 1, c.name, c.tp)
+                c._index = index
+        return self._index
 
     @property
     def is_empty(self) -> bool:
-        return len(self.container) == 0
+        return self.parent is None
 
     def get_last(self) -> Tuple[str, Term] | None:
         if self.is_empty:
             return None
-        return self.container[-1]
+        return self.car()
 
-    def get_ahead(self):
-        if self.is_empty:
-            return None
-        return Context(self.container[:-1])
+    def get_ahead(self) -> "Context | None":
+        return self.parent
 
-    def __eq__(self, that):
+    def __eq__(self, that: object) -> bool:
+        # 文脈はたいてい共通の祖先を伸ばして作られるので、
+        # 長さとハッシュを比べたあと、共通の祖先に行き着くまでの差分だけを比べる
+        stats = Context.eq_stats
         if self is that:
+            stats["identical"] += 1
             return True
-        if len(self.container) != len(that.container):
-            return False
-
-        def fst(b):
-            return b[0]
-
-        if list(map(fst, self.container)) != list(map(fst, that.container)):
+        if not isinstance(that, Context):
             return False
-
-        def snd(b):
-            return b[1]
-
-        if any(
-            map(
-                lambda p: p[0] != p[1],
-                zip(map(snd, self.container), map(snd, that.container)),
-            )
-        ):
+        if self.size != that.size or hash(self) != hash(that):
+            stats["rejected"] += 1
             return False
+        stats["walked"] += 1
+        c1: Context | None = self
+        c2: Context | None = that
+        while c1 is not c2 and c1 is not None and c2 is not None:
+            stats["compared"] += 1
+            if c1.name != c2.name or c1.tp != c2.tp:
+                return False
+            c1, c2 = c1.parent, c2.parent
         return True
 
-    def cdr(self):
-        return Context(self.container[:-1])
+    def __hash__(self) -> int:
+        # 名前と型のα同値類から求める構造的なハッシュ。一度求めたら使い回す
+        if self._hash is None:
+            uncached: list[Context] = []
+            c: Context | None = self
+            while c is not None and c._hash is None:
+                uncached.append(c)
+                c = c.parent
+            h = 0 if c is None else c._hash
+            for c in reversed(uncached):
+                h = 0 if c.parent is None else hash((h, c.name, c.tp))
+                c._hash = h
+        return self._hash
+
+    def __reduce__(self):
+        return (Context, (list(self.bindings()),))
+
+    def cdr(self) -> "Context":
+        return self if self.parent is None else self.parent
+
+    def car(self) -> Tuple[str, Term]:
+        if self.parent is None:
+            raise IndexError("empty context")
+        return self.name, self.tp
+
+    def bindings(self) -> Tuple[Tuple[str, Term], ...]:
+        # 外側から順に並べた束縛。親をたどって集める
+        bindings: list[Tuple[str, Term]] = []
+        c: Context = self
+        while c.parent is not None:
+            bindings.append((c.name, c.tp))
+            c = c.parent
+        bindings.reverse()
+        return tuple(bindings)
 
-    def car(self):
-        return self.container[-1]
+    @property
+    def container(self) -> list[Tuple[str, Term]]:
+        # 互換用
+        return list(self.bindings())
 
     def __str__(self) -> str:
         return ", ".join(
-            map(lambda binding: f"{binding[0]}:{binding[1]}", self.container)
+            map(lambda binding: f"{binding[0]}:{binding[1]}", self.bindings())
         )
 
-    def params(self) -> list[str]:
-        def fst(d: Tuple[str, Term]) -> str:
-            return d[0]
+    def params(self) -> Tuple[str, ...]:
+        return self.names_tps()[0]
+
+    def names_tps(self) -> Tuple[Tuple[str, ...], Tuple[Term, ...]]:
+        # 定義の文脈で何度も使うので、一度求めたら使い回す
+        if self._names_tps is None:
+            bindings = self.bindings()
+            self._names_tps = (
+                tuple(b[0] for b in bindings),
+                tuple(b[1] for b in bindings),
+            )
+        return self._names_tps
 
-        return list(map(fst, self.container))
 
-    def names_tps(self) -> Tuple[list[str], list[Term]]:
-        names: list[str] = []
-        tps: list[Term] = []
-        for b in self.container:
-            names.append(b[0])
-            tps.append(b[1])
-        return names, tps
+EMPTY_CTX = Context._make(None, "", StarTerm())
 
 
 @dataclass(frozen=True)
@@ -145,14 +305,158 @@ class Definition:
             body = self.body.__str__()
         return f"{self.context} |> {self.op} := {body} : {self.prop}"
 
+    def __reduce__(self):
+        # キャッシュしたテンプレートは送らない
+        return (Definition, (self.op, self.context, self.body, self.prop, self.is_prim))
+
     @property
-    def names(self):
-        return list(map(lambda b: b[0], self.context.container))
+    def names(self) -> Tuple[str, ...]:
+        return self.context.params()
+
+    # δ簡約用のテンプレート。本体をパラメタが束縛変数になったnameless表現にしておき、
+    # 展開のたびにすべての引数を一度の走査で代入する（--engine namelessのとき）
+
+    @functools.cached_property
+    def template(self) -> nameless.NTerm:
+        return nameless.abstract(self.body, self.context.params())
+
+    def normal_body(self, env: "Sequence[Definition]") -> Term:
+        # 本体をβ・δ正規化したもの。一度求めたら使い回す。
+        # envは本体に現れる定数の定義を含む環境
+        n = self.__dict__.get("_normal_body")
+        if n is None:
+            n = bd_normalize(self.body, env)
+            self.__dict__["_normal_body"] = n
+        return n
+
+    def normal_template(self, env: "Sequence[Definition]") -> nameless.NTerm:
+        # normal_bodyをテンプレートにしたもの。一度求めたら使い回す
+        n = self.__dict__.get("_normal_template")
+        if n is None:
+            n = nameless.abstract(self.normal_body(env), self.context.params())
+            self.__dict__["_normal_template"] = n
+        return n
+
+
+class _OpIndex:
+    """
+    定数の名前から、環境の定義の列での位置への索引。
+    PVectorと同じく、環境の列（親と子）で一つの辞書を共有し、
+    各環境は位置が自分の長さ未満の項目だけを見る。
+    sizeはこの索引を使う一番長い環境の長さで、その環境を伸ばすときは辞書に書き足すだけで済む。
+    古い環境を伸ばす（分岐する）ときだけ、見える項目をコピーする。
+    """
+
+    __slots__ = ("offsets", "size")
+
+    def __init__(self, offsets: dict[str, int] | None = None, size: int = 0):
+        self.offsets: dict[str, int] = {} if offsets is None else offsets
+        self.size = size
+
+    def extended(self, size: int, op: str) -> "_OpIndex":
+        # 長さsizeの環境の索引に、位置sizeの定義opを書き足した索引
+        index = self
+        if self.size != size:
+            offsets = {o: i for o, i in self.offsets.items() if i < size}
+            index = _OpIndex(offsets, size)
+        index.offsets.setdefault(op, size)
+        index.size = size + 1
+        return index
+
+
+class Environment:
+    """
+    定義の列（デルタ）。
+    空の環境EMPTY_ENVから、def/defprのたびにextendで一つずつ伸ばして作る。
+    同じ環境を同じ定義で伸ばすと同じオブジェクトが返る（intern）ので、
+    環境が一致するかどうかはオブジェクトの同一性だけで判定できる。
+    debugをTrueにすると、同一でないときに定義を一つずつ比べる（遅い）。
+    """
+
+    debug = False
+    _next_eid = 0
+
+    def __init__(
+        self, parent: "Environment | None" = None, definition: Definition | None = None
+    ):
+        self.parent = parent
+        self.definition = definition
+        self.definitions: PVector[Definition] = (
+            PVector()
+            if parent is None or definition is None
+            else parent.definitions.append(definition)
+        )
+        self.eid = Environment._next_eid
+        Environment._next_eid += 1
+        self._children: dict[str, list[Environment]] = {}
+        self._ops = (
+            _OpIndex()
+            if parent is None or definition is None
+            else parent._ops.extended(len(parent), definition.op)
+        )
+
+    def extend(self, dfn: Definition) -> "Environment":
+        children = self._children.setdefault(dfn.op, [])
+        for child in children:
+            if child.definition == dfn:
+                return child
+        child = Environment(self, dfn)
+        children.append(child)
+        return child
+
+    def __eq__(self, that: object) -> bool:
+        if self is that:
+            return True
+        if Environment.debug and isinstance(that, Environment):
+            return self.definitions == that.definitions
+        return False
+
+    def __hash__(self) -> int:
+        return self.eid
+
+    def __len__(self) -> int:
+        return len(self.definitions)
+
+    def __getitem__(self, i: int) -> Definition:
+        return self.definitions[i]
+
+    def __iter__(self) -> Iterator[Definition]:
+        return iter(self.definitions)
+
+    def lookup(self, op: str) -> Tuple[int, Definition] | None:
+        # 名前がopの定義の位置と定義（同じ名前が複数あれば最初のもの）
+        i = self._ops.offsets.get(op)
+        if i is None or i >= len(self.definitions):
+            return None
+        return i, self.definitions[i]
+
+    def __reduce__(self):
+        # 定義の列として送り、受け取ったプロセスでEMPTY_ENVから伸ばし直す（intern）
+        return (environment_of, (tuple(self.definitions),))
+
+
+EMPTY_ENV = Environment()
+
+
+def lookup_definition(
+    env: Sequence[Definition], op: str
+) -> Tuple[int, Definition] | None:
+    # 環境（Environmentでなくてもよい）で名前がopの定義の位置と定義
+    if isinstance(env, Environment):
+        return env.lookup(op)
+    return next(((i, dfn) for i, dfn in enumerate(env) if dfn.op == op), None)
+
+
+def environment_of(dfns: Iterable[Definition]) -> Environment:
+    env = EMPTY_ENV
+    for dfn in dfns:
+        env = env.extend(dfn)
+    return env
 
 
 @dataclass(frozen=True)
 class Judgement:
-    environment: list[Definition]
+    environment: Environment
     context: Context
     proof: Term
     prop: Term
@@ -169,32 +473,431 @@ def fmtErr_(inst: Instruction, msg: str) -> VerificationError:
     return VerificationError(f"at: {inst}\n{msg}")
 
 
+Book = PVector[Judgement]
+
+
 def check(inst: Instruction, book: list[Judgement]) -> list[Judgement]:
+    # 互換用: 新しいリストを返す（元のbookは変更しない）。
+    # 長い命令列を検査するときはcheck_bookを使うこと
+    if isinstance(book, PVector):
+        return check_book(inst, book)
+    j = judge(inst, book)
+    if j is None:
+        return book
+    _book = book.copy()
+    _book.append(j)
+    return _book
+
+
+def check_book(inst: Instruction, book: Book) -> Book:
+    # bookを共有したまま、instの結論を追記した版をO(1)で返す
+    j = judge(inst, book)
+    if j is None:
+        return book
+    return book.append(j)
+
+
+class LiveBook:
+    """
+    まだ後の命令から参照される判断だけを持つbook。
+    判断は追加された順に0から番号がつき、releaseした判断は参照できなくなる。
+    max_liveは同時に持っていた判断の数の最大値。
+    """
+
+    def __init__(self, judgements: dict[int, Judgement] | None = None, size: int = 0):
+        # judgementsとsizeを渡すと、size個の判断のうちjudgementsだけを持つbookから始める
+        self.judgements: dict[int, Judgement] = {} if judgements is None else judgements
+        self.size = size
+        self.max_live = len(self.judgements)
+
+    def __getitem__(self, i: int) -> Judgement:
+        try:
+            return self.judgements[i]
+        except KeyError:
+            raise IndexError(f"judgement {i} is not live")
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, j: Judgement):
+        self.judgements[self.size] = j
+        self.size += 1
+        self.max_live = max(self.max_live, len(self.judgements))
+
+    def release(self, i: int):
+        self.judgements.pop(i, None)
+
+
+def check_live(
+    insts: Iterable[Instruction], last: dict[int, int], out=None
+) -> LiveBook:
+    # lastは判断の番号から、それを最後に参照する命令の位置への写像（inst.last_uses）。
+    # 最後の参照を検査し終えた判断と、一度も参照されない判断はすぐに捨てる。
+    # outを渡すと、判断を導いたそばから出力する
+    schedule = release_schedule(last)
+    book = LiveBook()
+    for pos, inst in enumerate(insts):
+        j = judge(inst, book)
+        for i in schedule.get(pos, ()):
+            book.release(i)
+        if j is None:
+            continue
+        index = len(book)
+        if out is not None:
+            print(index, j, file=out)
+        book.append(j)
+        if last.get(index, -1) <= pos:
+            book.release(index)
+    return book
+
+
+def check_stream(filename: str, out=sys.stdout) -> LiveBook:
+    # ファイルを一命令ずつ読んで検査し、判断を導いたそばから出力する。
+    # 先に各判断の最後の参照を調べておき、もう参照されない判断はbookから捨てる。
+    # テキスト形式なら、最初の走査では項を読まずに参照だけを取り出す
+    if binfmt.is_binary(filename):
+        last = last_uses(map(premises, binfmt.read_binary(filename)))
+    else:
+        with open(filename, "r") as f:
+            last = last_uses(scan_premises(line.replace("\n", "")) for line in f)
+    return check_live(binfmt.read_insts(filename), last, out)
+
+
+def max_live(insts: InstructionArray) -> int:
+    # 最後の参照を過ぎた判断を捨てながら検査したときに、同時に持つ判断の数の最大値。
+    # 命令のオブジェクトは作らずに、配列から直接求める
+    last = last_uses(insts.all_premises())
+    schedule = release_schedule(last)
+    live = 0
+    peak = 0
+    index = 0
+    for pos, op in enumerate(insts.ops):
+        live -= len(schedule.get(pos, ()))
+        if op == OP_END:
+            continue
+        live += 1
+        peak = max(peak, live)
+        if last.get(index, -1) <= pos:
+            live -= 1
+        index += 1
+    return peak
+
+
+"""
+# 並列検査
+
+def/defprで区切った命令列（区間）を、プロセスプールで並列に検査する。
+
+1. 項を見ずに命令列を走査して、各区間の環境がどのdef/defprで伸ばしたものか（chain）と、
+   区間の検査に中身が要る定義（deps: 区間のinstが参照する定義と、それらの検査に要った定義）を求める。
+2. 区間が参照する定義の区間がすべて検査に通ったら、その区間をワーカーに送る。
+   環境のうちdepsにない定義は、名前だけ同じ仮の定義（primで本体も型も*）に置き換える。
+   区間の中の項に現れる定数はdepsの定義だけなので、検査の結果は変わらない。
+3. ワーカーは区間の判断と、区間の最後のdef/defprが導く定義を返す。
+   判断の環境は長さだけで返し、親プロセスで本当の環境に付け替えてbookを作る。
+
+区間の外から参照する判断は、どれも「環境 ⊢ * : @」（sortと、それをdef/defpr・cpでつないだもの）
+でなければならない。deriveが生成する命令列はこの形で、各区間は直前のdefの判断だけを参照する。
+この形でない命令列と、通らない区間があったときは、逐次に検査する（check_in_order）。
+エラーは逐次に検査したときと同じものになる。
+
+互いに参照しない定義の区間は同時に検査するので、定義の参照の鎖が短いほど速くなる。
+ワーカーで生成するフレッシュな名前は、その区間に送る定義を作ったワーカーより先の番号から始める。
+
+結果のキャッシュ（cache.py）を使うときは、前に検査に通った区間は結論だけを求める（trusted）。
+区間の鍵は仮の定義に置き換えた環境から求めるので、depsにない定義を書き換えても鍵は変わらない。
+"""
+
+
+def segments(insts: Sequence[Instruction]) -> list[Tuple[int, int]]:
+    # def/defprの直後で区切った区間の、始まりと終わりの位置
+    bounds: list[Tuple[int, int]] = []
+    start = 0
+    for pos, inst in enumerate(insts):
+        if isinstance(inst, DefInst) or isinstance(inst, DefPrInst):
+            bounds.append((start, pos + 1))
+            start = pos + 1
+    if start < len(insts):
+        bounds.append((start, len(insts)))
+    return bounds
+
+
+@dataclass(frozen=True)
+class SegmentPlan:
+    start: int
+    end: int
+    size: int  # 区間の前の判断の数
+    chain: Tuple[int, ...]  # 区間の環境を伸ばしたdef/defprの位置の列
+    imported: dict[int, int]  # 区間の外から参照する判断から、その環境の長さへの写像
+    deps: frozenset[int]  # 区間の検査に中身が要る定義（def/defprの位置）
+    defines: int | None  # 区間の最後のdef/defprの位置
+
+
+def plan_segments(insts: Sequence[Instruction]) -> list[SegmentPlan] | None:
+    # 区間ごとの環境と、中身が要る定義を求める。
+    # 区間の外から参照する判断が「環境 ⊢ * : @」でなければNoneを返す
+    chains: dict[int, Tuple[int, ...]] = {}  # 「環境 ⊢ * : @」の判断から、その環境のchain
+    deps_of: dict[int, frozenset[int]] = {}  # def/defprの位置から、その区間のdeps
+    plans: list[SegmentPlan] = []
+    size = 0
+    for start, end in segments(insts):
+        imported = {i for inst in insts[start:end] for i in premises(inst) if i < size}
+        if not imported <= chains.keys():
+            return None
+        chain = max((chains[i] for i in imported), key=len, default=())
+        if any(chain[: len(chains[i])] != chains[i] for i in imported):
+            return None
+        uses: set[int] = set()
+        index = size
+        for pos in range(start, end):
+            match insts[pos]:
+                case SortInst(_lnum):
+                    chains[index] = ()
+                case DefInst(_lnum, pre1) | DefPrInst(_lnum, pre1) if pre1 in chains:
+                    chains[index] = chains[pre1] + (pos,)
+                case CPInst(_lnum, target) if target in chains:
+                    chains[index] = chains[target]
+                case InstInst(op_offset=op_offset):
+                    if not 0 <= op_offset < len(chain):
+                        return None
+                    uses.add(chain[op_offset])
+                case EndInst():
+                    continue
+            index += 1
+        deps = set(uses)
+        for d in uses:
+            deps |= deps_of[d]
+        defines = None
+        if isinstance(insts[end - 1], DefInst) or isinstance(insts[end - 1], DefPrInst):
+            defines = end - 1
+        plan = SegmentPlan(
+            start,
+            end,
+            size,
+            chain,
+            {i: len(chains[i]) for i in imported},
+            frozenset(deps),
+            defines,
+        )
+        if defines is not None:
+            deps_of[defines] = plan.deps
+        plans.append(plan)
+        size = index
+    return plans
+
+
+def partial_definitions(
+    insts: Sequence[Instruction], plan: SegmentPlan, definitions: dict[int, Definition]
+) -> list[Definition]:
+    # 区間の環境の定義の列。depsにない定義は、名前だけ同じ仮の定義にする
+    return [
+        definitions[d] if d in plan.deps else _placeholder(insts[d])
+        for d in plan.chain
+    ]
+
+
+def _placeholder(inst: Instruction) -> Definition:
+    assert isinstance(inst, DefInst) or isinstance(inst, DefPrInst)
+    return Definition(inst.op, EMPTY_CTX, StarTerm(), StarTerm(), is_prim=True)
+
+
+def imported_judgements(
+    dfns: Sequence[Definition], imported: dict[int, int]
+) -> dict[int, Judgement]:
+    # 環境がdfnsの前半の「環境 ⊢ * : @」の判断
+    envs = [EMPTY_ENV]
+    for dfn in dfns[: max(imported.values(), default=0)]:
+        envs.append(envs[-1].extend(dfn))
+    return {
+        i: Judgement(envs[n], EMPTY_CTX, StarTerm(), SortTerm())
+        for i, n in imported.items()
+    }
+
+
+def check_segments(
+    insts: Sequence[Instruction], jobs: int = 1, cache: "ResultCache | None" = None
+) -> Book:
+    # jobsが2以上なら区間をプロセスプールで検査する。
+    # cacheを渡すと、前に検査に通った区間（鍵が同じもの）は結論だけを求め、通った区間を記録する
+    plans = plan_segments(insts)
+    if jobs > 1 and plans is not None and len(plans) > 1:
+        book = _check_segments_in_pool(insts, plans, jobs, cache)
+        if book is not None:
+            return book
+    return check_in_order(insts, cache, plans)
+
+
+def check_in_order(
+    insts: Sequence[Instruction],
+    cache: "ResultCache | None" = None,
+    plans: list[SegmentPlan] | None = None,
+) -> Book:
+    # 先頭から一命令ずつ、一度だけ検査する。
+    # plansがあれば、区間の鍵は並列検査と同じく仮の定義に置き換えた環境から求める
+    book = Book()
+    definitions: dict[int, Definition] = {}
+    for k, (start, end) in enumerate(segments(insts)):
+        seg = insts[start:end]
+        key = None
+        trusted = False
+        if cache is not None:
+            if plans is not None:
+                dfns = partial_definitions(insts, plans[k], definitions)
+                imported = imported_judgements(dfns, plans[k].imported)
+            else:
+                imported = {
+                    i: book[i]
+                    for inst in seg
+                    for i in premises(inst)
+                    if i < len(book)
+                }
+            key = cache.segment_key(seg, len(book), imported)
+            trusted = cache.is_checked(key)
+        for inst in seg:
+            j = judge(inst, book, trusted)
+            if j is not None:
+                book = book.append(j)
+        if plans is not None and plans[k].defines is not None:
+            dfn = book[len(book) - 1].environment.definition
+            assert dfn is not None
+            definitions[end - 1] = dfn
+        if cache is not None and key is not None and not trusted:
+            cache.put_checked(key)
+    return book
+
+
+def _init_checker(options: tuple):
+    engine, normalizer, conversion, nf_cache_size, debug = options
+    substitution.set_engine(engine)
+    set_normalizer(normalizer)
+    set_conversion(conversion)
+    NORMAL_FORMS.resize(nf_cache_size)
+    Environment.debug = debug
+
+
+def _check_segment(task: tuple):
+    # ワーカーで区間を検査し、判断を（環境の長さ、文脈、証明、命題）の組で返す。
+    # 検査に失敗すればVerificationErrorが親プロセスに伝わる
+    insts, size, dfns, imported, trusted, fresh = task
+    Fresh.advance(fresh)
+    book = LiveBook(imported_judgements(dfns, imported), size)
+    judgements = []
+    for inst in insts:
+        j = judge(inst, book, trusted)
+        if j is not None:
+            book.append(j)
+            judgements.append((len(j.environment), j.context, j.proof, j.prop))
+    defined = None
+    if isinstance(insts[-1], DefInst) or isinstance(insts[-1], DefPrInst):
+        defined = book[len(book) - 1].environment.definition
+    return judgements, defined, Fresh.count()
+
+
+def _check_segments_in_pool(
+    insts: Sequence[Instruction],
+    plans: list[SegmentPlan],
+    jobs: int,
+    cache: "ResultCache | None",
+) -> Book | None:
+    # 通らない区間があればNoneを返す
+    options = (
+        substitution.ENGINE,
+        NORMALIZER,
+        CONVERSION,
+        NORMAL_FORMS.maxsize,
+        Environment.debug,
+    )
+    definitions: dict[int, Definition] = {}
+    results: dict[int, list[tuple]] = {}
+    waiting = {k: len(plan.deps) for k, plan in enumerate(plans)}
+    waiters: dict[int, list[int]] = {}  # 定義から、それを待つ区間への写像
+    for k, plan in enumerate(plans):
+        for d in plan.deps:
+            waiters.setdefault(d, []).append(k)
+    ready = [k for k, n in waiting.items() if n == 0]
+    fresh = Fresh.count()
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_checker, initargs=(options,)
+    ) as pool:
+        running: dict[Future, Tuple[int, str | None]] = {}
+        while ready or running:
+            for k in ready:
+                plan = plans[k]
+                seg = list(insts[plan.start : plan.end])
+                dfns = partial_definitions(insts, plan, definitions)
+                key = None
+                trusted = False
+                if cache is not None:
+                    imported = imported_judgements(dfns, plan.imported)
+                    key = cache.segment_key(seg, plan.size, imported)
+                    trusted = cache.is_checked(key)
+                task = (seg, plan.size, dfns, plan.imported, trusted, fresh)
+                future = pool.submit(_check_segment, task)
+                running[future] = (k, None if trusted else key)
+            ready = []
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                k, key = running.pop(future)
+                try:
+                    judgements, defined, count = future.result()
+                except Exception:
+                    pool.shutdown(cancel_futures=True)
+                    return None
+                if cache is not None and key is not None:
+                    cache.put_checked(key)
+                results[k] = judgements
+                fresh = max(fresh, count)
+                defines = plans[k].defines
+                if defines is not None:
+                    definitions[defines] = defined
+                    for w in waiters.get(defines, ()):
+                        waiting[w] -= 1
+                        if waiting[w] == 0:
+                            ready.append(w)
+    Fresh.advance(fresh)
+
+    # 判断を本当の環境に付け替える。def_envs[d]は位置dのdef/defprが導く環境
+    book = Book()
+    def_envs: dict[int, Environment] = {}
+
+    def prefix(chain: Tuple[int, ...], n: int) -> Environment:
+        return EMPTY_ENV if n == 0 else def_envs[chain[n - 1]]
+
+    for k, plan in enumerate(plans):
+        judgements = results[k]
+        for i, (n, context, proof, prop) in enumerate(judgements):
+            if plan.defines is not None and i == len(judgements) - 1:
+                env = prefix(plan.chain, n - 1).extend(definitions[plan.defines])
+                def_envs[plan.defines] = env
+            else:
+                env = prefix(plan.chain, n)
+            book = book.append(Judgement(env, context, proof, prop))
+    return book
+
+
+def judge(
+    inst: Instruction, book: Sequence[Judgement], trusted: bool = False
+) -> Judgement | None:
+    # bookを前提として、instが導く判断を返す。bookは変更しない。
+    # 判断を追加しない命令（end）に対してはNoneを返す。
+    # trustedなら、時間のかかる検査（β・δ同値性と、instの引数の型）を省いて結論だけを求める
     match inst:
         case SortInst(_lnum):
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=[],
-                    context=Context([]),
-                    proof=parse_term("*"),
-                    prop=parse_term("@"),
-                )
+            return Judgement(
+                environment=EMPTY_ENV,
+                context=EMPTY_CTX,
+                proof=parse_term("*"),
+                prop=parse_term("@"),
             )
-            return _book
         case VarInst(_lnum, pre, var):
             premise = book[pre]
             var_name: str = inst.var.name
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=premise.environment,
-                    context=premise.context.extend(var_name, premise.proof),
-                    proof=var,
-                    prop=premise.proof,
-                )
+            return Judgement(
+                environment=premise.environment,
+                context=premise.context.extend(var_name, premise.proof),
+                proof=var,
+                prop=premise.proof,
             )
-            return _book
         case WeakInst(_lnum, pre1, pre2, var):
             try:
                 premise1 = book[pre1]
@@ -206,20 +909,16 @@ def check(inst: Instruction, book: list[Judgement]) -> list[Judgement]:
                 raise fmtErr_(inst, "environments are not agree")
             if premise1.context != premise2.context:
                 raise fmtErr_(inst, "contexts are not agree")
-            if new_name in premise1.context.params():
+            if premise1.context.get(new_name) is not None:
                 raise fmtErr_(
                     inst, f"variable {new_name} is already used in the context"
                 )
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=premise1.environment,
-                    context=premise1.context.extend(new_name, premise2.proof),
-                    proof=premise1.proof,
-                    prop=premise1.prop,
-                )
+            return Judgement(
+                environment=premise1.environment,
+                context=premise1.context.extend(new_name, premise2.proof),
+                proof=premise1.proof,
+                prop=premise1.prop,
             )
-            return _book
         case FormInst(_lnum, pre1, pre2):
             premise1 = book[pre1]
             premise2 = book[pre2]
@@ -232,18 +931,12 @@ def check(inst: Instruction, book: list[Judgement]) -> list[Judgement]:
                     inst,
                     "proof of pre1 does not agree with last type of the pre2 context",
                 )
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=premise1.environment,
-                    context=premise1.context,
-                    proof=PiTerm(
-                        premise1.proof, premise2.proof, premise2.context.car()[0]
-                    ),
-                    prop=premise2.prop,
-                )
+            return Judgement(
+                environment=premise1.environment,
+                context=premise1.context,
+                proof=PiTerm(premise1.proof, premise2.proof, premise2.context.car()[0]),
+                prop=premise2.prop,
             )
-            return _book
         case ApplInst(_lnum, pre1, pre2):
             premise1 = book[pre1]
             premise2 = book[pre2]
@@ -259,16 +952,12 @@ def check(inst: Instruction, book: list[Judgement]) -> list[Judgement]:
                     raise fmtErr_(
                         inst, "pre1 parameter type does not agree with pre2 type"
                     )
-                _book = book.copy()
-                _book.append(
-                    Judgement(
-                        environment=premise1.environment,
-                        context=premise1.context,
-                        proof=AppTerm(premise1.proof, premise2.proof),
-                        prop=subst(mb_funtype.t2, premise2.proof, mb_funtype.name),
-                    )
+                return Judgement(
+                    environment=premise1.environment,
+                    context=premise1.context,
+                    proof=AppTerm(premise1.proof, premise2.proof),
+                    prop=subst(mb_funtype.t2, premise2.proof, mb_funtype.name),
                 )
-                return _book
         case AbstInst(_lnum, pre1, pre2):
             premise1 = book[pre1]
             premise2 = book[pre2]
@@ -296,16 +985,12 @@ def check(inst: Instruction, book: list[Judgement]) -> list[Judgement]:
                     """,
                 )
 
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=premise2.environment,
-                    context=premise2.context,
-                    proof=LambdaTerm(mb_pi_term.t1, premise1.proof, mb_pi_term.name),
-                    prop=premise2.proof,
-                )
+            return Judgement(
+                environment=premise2.environment,
+                context=premise2.context,
+                proof=LambdaTerm(mb_pi_term.t1, premise1.proof, mb_pi_term.name),
+                prop=premise2.proof,
             )
-            return _book
         case ConvInst(_lnum, pre1, pre2):
             premise1 = book[pre1]
             premise2 = book[pre2]
@@ -313,51 +998,43 @@ def check(inst: Instruction, book: list[Judgement]) -> list[Judgement]:
                 raise fmtErr_(inst, "environments are not agree")
             if premise1.context != premise2.context:
                 raise fmtErr_(inst, "contexts are not agree")
-            if not bd_eqv(premise1.prop, premise2.proof, premise1.environment):
+            if not trusted and not bd_eqv(
+                premise1.prop, premise2.proof, premise1.environment
+            ):
                 raise fmtErr_(
                     inst,
                     f"pre2.proof must be beta-delta eqv to pre1 prop\n{premise1.prop} vs. {premise2.proof}",
                 )
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=premise1.environment,
-                    context=premise1.context,
-                    proof=premise1.proof,
-                    prop=premise2.proof,
-                )
+            return Judgement(
+                environment=premise1.environment,
+                context=premise1.context,
+                proof=premise1.proof,
+                prop=premise2.proof,
             )
-            return _book
         case DefInst(_lnum, pre1, pre2, op):
             premise1 = book[pre1]
             premise2 = book[pre2]
             if premise1.environment != premise2.environment:
                 raise fmtErr_(inst, "environments are not agree")
-            if op in map(lambda d: d.op, premise1.environment):
+            if premise1.environment.lookup(op) is not None:
                 raise fmtErr_(
                     inst, f"constant {op} is already defined in the environment"
                 )
             dfn = Definition(
                 op=op, context=premise2.context, body=premise2.proof, prop=premise2.prop
             )
-            _env = premise1.environment.copy()
-            _env.append(dfn)
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=_env,
-                    context=premise1.context,
-                    proof=premise1.proof,
-                    prop=premise1.prop,
-                )
+            return Judgement(
+                environment=premise1.environment.extend(dfn),
+                context=premise1.context,
+                proof=premise1.proof,
+                prop=premise1.prop,
             )
-            return _book
         case DefPrInst(_lnum, pre1, pre2, op):
             premise1 = book[pre1]
             premise2 = book[pre2]
             if premise1.environment != premise2.environment:
                 raise fmtErr_(inst, "environments are not agree")
-            if op in map(lambda d: d.op, premise1.environment):
+            if premise1.environment.lookup(op) is not None:
                 raise fmtErr_(
                     inst, f"constant {op} is already defined in the environment"
                 )
@@ -368,18 +1045,12 @@ def check(inst: Instruction, book: list[Judgement]) -> list[Judgement]:
                 prop=premise2.proof,
                 is_prim=True,
             )
-            _env = premise1.environment.copy()
-            _env.append(dfn)
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=_env,
-                    context=premise1.context,
-                    proof=premise1.proof,
-                    prop=premise1.prop,
-                )
+            return Judgement(
+                environment=premise1.environment.extend(dfn),
+                context=premise1.context,
+                proof=premise1.proof,
+                prop=premise1.prop,
             )
-            return _book
         case InstInst(_lnum, pre, _length, pres, op_offset):
             # instとinst-primを区別する必要はない
             premise = book[pre]
@@ -391,56 +1062,44 @@ def check(inst: Instruction, book: list[Judgement]) -> list[Judgement]:
             if premise.proof != StarTerm() or premise.prop != SortTerm():
                 raise fmtErr_(inst, "bad premise {premise}")
             dfn = premise.environment[op_offset]
-            if len(dfn.context.container) != len(premises):
+            if dfn.context.size != len(premises):
                 raise fmtErr_(inst, "arity mismatch")
-            if not check_arity_type(dfn, premises):
+            if not trusted and not check_arity_type(dfn, premises):
                 raise fmtErr_(inst, "arg type mismatch")
 
             pre_proofs = [p.proof for p in premises]
             prop = subst_all(dfn.prop, dfn.names, pre_proofs)
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=premise.environment,
-                    context=premise.context,
-                    proof=ConstTerm(dfn.op, pre_proofs),
-                    prop=prop,
-                )
+            return Judgement(
+                environment=premise.environment,
+                context=premise.context,
+                proof=ConstTerm(dfn.op, pre_proofs),
+                prop=prop,
             )
-            return _book
         case CPInst(_lnum, target):
-            _book = book.copy()
-            _book.append(book[target])
-            return _book
+            return book[target]
         case SPInst(_lnum, target, bind):
             j = book[target]
-            binding = j.context.container[bind]
-            _book = book.copy()
-            _book.append(
-                Judgement(
-                    environment=j.environment,
-                    context=j.context,
-                    proof=parse_term(binding[0]),
-                    prop=binding[1],
-                )
+            binding = j.context.bindings()[bind]
+            return Judgement(
+                environment=j.environment,
+                context=j.context,
+                proof=parse_term(binding[0]),
+                prop=binding[1],
             )
-            return _book
         case EndInst(_lnum):
-            return book
+            return None
         case _:
             raise fmtErr_(inst, "have not implemented")
 
 
 def check_arity_type(dfn: Definition, premises: list[Judgement]) -> bool:
-    us = map(lambda pre: pre.proof, premises)
-    sbst = list(zip(dfn.names, us))
+    # i番目の引数の型が、パラメタの型Aiに前のi個の引数を同時代入したものと一致するか
+    names, tps = dfn.context.names_tps()
+    sbst: dict[str, Term] = {}
     for i, pre in enumerate(premises):
         pre_prop = pre.prop
-        a = functools.reduce(
-            lambda a, b: subst(a, b[1], b[0]),
-            sbst[:i],
-            dfn.context.container[i][1],  # A
-        )
+        a = subst_many(tps[i], sbst)
+        sbst[names[i]] = pre.proof
         if pre_prop != a:
             print(f"{pre_prop=}\n{a=}")
             return False
@@ -467,48 +1126,166 @@ class NormalizationError(Exception):
     pass
 
 
-def fmtErrN_(t: Term, env: list[Definition], msg: str):
+def fmtErrN_(t: Term, env: Sequence[Definition], msg: str):
     return NormalizationError(f"{t}:\n  {msg}")
 
 
-def bd_eqv(t1: Term, t2: Term, env: list[Definition]) -> bool:
-    n1 = normalize(t1, env)
-    n2 = normalize(t2, env)
+# 正規化の実装
+#   naive: normalize。部分項から正規化し、β・δ簡約のたびに代入してから正規化し直す
+#   nbe:   nbe.py。値に評価してから読み戻す（Normalization by Evaluation）
+NORMALIZERS = ["naive", "nbe"]
+NORMALIZER = "naive"
+
+
+def set_normalizer(normalizer: str):
+    global NORMALIZER
+    if normalizer not in NORMALIZERS:
+        raise NormalizationError(f"unknown normalizer: {normalizer}")
+    NORMALIZER = normalizer
+
+
+class NormalFormCache:
+    """
+    β・δ正規形のLRUキャッシュ。
+    キーは項のidと環境のeidの組。ハッシュコンシングで同じ項は同じオブジェクトになり、
+    環境もinternされているので、同じ命題を同じ環境で正規化し直すときにヒットする。
+    項のidが使い回されないように、エントリは元の項も持っておく。
+    eidは使い回されないので、環境のほうは持っておかなくてよい。
+    maxsizeが0ならキャッシュせず、ヒットもミスも数えない。
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.entries: OrderedDict[Tuple[int, int], Tuple[Term, Term]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, t: Term, env: Environment) -> Term | None:
+        # 無効なときはヒットもミスも数えない
+        if self.maxsize <= 0:
+            return None
+        key = (id(t), env.eid)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, t: Term, env: Environment, n: Term):
+        if self.maxsize <= 0:
+            return
+        self.entries[(id(t), env.eid)] = (t, n)
+        self.entries.move_to_end((id(t), env.eid))
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, maxsize: int):
+        self.maxsize = maxsize
+        while len(self.entries) > max(maxsize, 0):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __str__(self) -> str:
+        return (
+            f"normal form cache: {self.hits} hits, {self.misses} misses, "
+            f"{self.evictions} evictions, {len(self.entries)}/{self.maxsize} entries"
+        )
+
+
+NORMAL_FORMS = NormalFormCache()
+
+
+def bd_normalize(t: Term, env: Sequence[Definition]) -> Term:
+    # β・δ正規形を、選択中の実装で求める。
+    # 環境がEnvironmentのときはNORMAL_FORMSにキャッシュする
+    if not isinstance(env, Environment):
+        return bd_normalize_uncached(t, env)
+    n = NORMAL_FORMS.get(t, env)
+    if n is None:
+        n = bd_normalize_uncached(t, env)
+        NORMAL_FORMS.put(t, env, n)
+    return n
+
+
+def bd_normalize_uncached(t: Term, env: Sequence[Definition]) -> Term:
+    if NORMALIZER == "nbe":
+        return nbe.normalize(t, env)
+    return normalize(t, env)
+
+
+# β・δ同値性の判定方法
+#   lazy:      conv_eqv。頭から必要な分だけ簡約しながら比べる
+#   normalize: 両辺を正規化してからα同値性を比べる
+CONVERSIONS = ["lazy", "normalize"]
+CONVERSION = "lazy"
+
+
+def set_conversion(conversion: str):
+    global CONVERSION
+    if conversion not in CONVERSIONS:
+        raise NormalizationError(f"unknown conversion: {conversion}")
+    CONVERSION = conversion
+
+
+def bd_eqv(t1: Term, t2: Term, env: Sequence[Definition]) -> bool:
+    if CONVERSION == "lazy":
+        return conv_eqv(t1, t2, env)
+    n1 = bd_normalize(t1, env)
+    n2 = bd_normalize(t2, env)
     return alpha_eqv(n1, n2)
 
 
-def normalize(t: Term, env: list[Definition]) -> Term:
+def normalize(t: Term, env: Sequence[Definition]) -> Term:
+    # 深い項でも再帰しないように、normalizingをtrampolineで実行する
+    return trampoline.run(normalizing(t, env))
+
+
+def normalizing(t: Term, env: Sequence[Definition]) -> Step[Term]:
     if type(t) in [VarTerm, StarTerm, SortTerm]:
         return t
     elif isinstance(t, AppTerm):
-        t1 = normalize(t.t1, env)
-        t2 = normalize(t.t2, env)
+        t1 = yield normalizing(t.t1, env)
+        t2 = yield normalizing(t.t2, env)
         if isinstance(t1, LambdaTerm):
-            return normalize(beta_reduction(t1, t2), env)
+            return (yield normalizing(beta_reduction(t1, t2), env))
         else:
             return AppTerm(t1, t2)
-    elif isinstance(t, LambdaTerm):
-        return LambdaTerm(normalize(t.t1, env), normalize(t.t2, env), t.name)
-    elif isinstance(t, PiTerm):
-        return PiTerm(normalize(t.t1, env), normalize(t.t2, env), t.name)
+    elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+        t1 = yield normalizing(t.t1, env)
+        t2 = yield normalizing(t.t2, env)
+        return type(t)(t1, t2, t.name)
     elif isinstance(t, ConstTerm):
-        children = list(map(lambda tt: normalize(tt, env), t.children))
-        mb_dfn = next(dfn for dfn in env if dfn.op == t.op)
-        if not mb_dfn:
+        children: list[Term] = []
+        for tt in t.children:
+            children.append((yield normalizing(tt, env)))
+        found = lookup_definition(env, t.op)
+        if found is None:
             raise fmtErrN_(t, env, "definition not found")
-        dfn = mb_dfn
-        if len(dfn.context.container) != len(children):
+        dfn = found[1]
+        if dfn.context.size != len(children):
             # 型検査通ってるのでokなはず？
             raise fmtErrN_(t, env, "arity mismatch")
         if dfn.is_prim:
             return ConstTerm(op=t.op, children=children)
         else:
-            return normalize(delta_reduction(dfn, children), env)
+            return (yield normalizing(delta_reduction_normal(dfn, children, env), env))
     else:
         raise fmtErrN_(t, env, "not implemented yet")
 
 
 def beta_reduction(f: LambdaTerm, t: Term) -> Term:
+    if substitution.ENGINE == "nameless":
+        return nameless.beta_reduction(f, t)
     fresh_name = Fresh.fresh()
     escaped_t = rename(t, f.name, fresh_name)
     return subst(f.t2, escaped_t, f.name)
@@ -517,29 +1294,263 @@ def beta_reduction(f: LambdaTerm, t: Term) -> Term:
 def delta_reduction(dfn: Definition, args: list[Term]) -> Term:
     if dfn.is_prim:
         raise NormalizationError("cannot reduce")
-    names = dfn.context.params()
-    return subst_all(dfn.body, names, args)
+    if substitution.ENGINE == "named":
+        # 名前つきの同時代入（subst_many_named）で、テンプレートを経由しない
+        return subst_all(dfn.body, list(dfn.names), args)
+    return instantiate_template(dfn.template, args)
+
+
+def delta_reduction_normal(
+    dfn: Definition, args: list[Term], env: Sequence[Definition]
+) -> Term:
+    # 正規化した本体に引数を代入する。引数が正規形でも、結果にはβ簡約基が残りうる
+    if dfn.is_prim:
+        raise NormalizationError("cannot reduce")
+    if substitution.ENGINE == "named":
+        return subst_all(dfn.normal_body(env), list(dfn.names), args)
+    return instantiate_template(dfn.normal_template(env), args)
+
+
+def instantiate_template(template: nameless.NTerm, args: list[Term]) -> Term:
+    values = [nameless.to_nameless(u) for u in args]
+    return nameless.from_nameless(nameless.instantiate_all(template, values))
+
+
+def conv_eqv(t1: Term, t2: Term, env: Sequence[Definition]) -> bool:
+    # 深い項でも再帰しないように、convertingをtrampolineで実行する
+    return trampoline.run(converting(t1, t2, env))
+
+
+def converting(t1: Term, t2: Term, env: Sequence[Definition]) -> Step[bool]:
+    # 正規化せずにβ・δ同値性を判定する。
+    # まずα同値性を調べ、だめなら両辺を弱頭部正規形までβ簡約して頭を比べる。
+    # 頭が定数でかみ合わないときだけδ簡約する。後で定義された定数ほど先に展開する
+    # （後の定数は前の定数を使って定義されるので、展開すると相手の形に近づく）。
+    # 同じ定数同士なら、展開する前に引数同士を比べてみる
+    if t1 == t2:
+        return True
+    t1 = whnf_beta(t1)
+    t2 = whnf_beta(t2)
+    while True:
+        if t1 == t2:
+            return True
+        h1, args1 = spine(t1)
+        h2, args2 = spine(t2)
+        if (
+            isinstance(h1, ConstTerm)
+            and isinstance(h2, ConstTerm)
+            and h1.op == h2.op
+            and len(args1) == len(args2)
+            and len(h1.children) == len(h2.children)
+            and (
+                yield all_converting(
+                    [*h1.children, *args1], [*h2.children, *args2], env
+                )
+            )
+        ):
+            return True
+        rank1 = unfolding_rank(h1, env)
+        rank2 = unfolding_rank(h2, env)
+        if rank1 < 0 and rank2 < 0:
+            break
+        if rank1 >= rank2:
+            t1 = whnf_beta(unfold_head(h1, args1, env))
+        if rank2 >= rank1:
+            t2 = whnf_beta(unfold_head(h2, args2, env))
+
+    # 頭はどちらもこれ以上簡約できない
+    if type(h1) != type(h2) or len(args1) != len(args2):
+        return False
+    if not (yield all_converting(args1, args2, env)):
+        return False
+    if isinstance(h1, VarTerm) and isinstance(h2, VarTerm):
+        return h1.name == h2.name
+    elif isinstance(h1, StarTerm) or isinstance(h1, SortTerm):
+        return True
+    elif isinstance(h1, ConstTerm) and isinstance(h2, ConstTerm):
+        return (
+            h1.op == h2.op
+            and len(h1.children) == len(h2.children)
+            and (yield all_converting(list(h1.children), list(h2.children), env))
+        )
+    elif (isinstance(h1, LambdaTerm) and isinstance(h2, LambdaTerm)) or (
+        isinstance(h1, PiTerm) and isinstance(h2, PiTerm)
+    ):
+        if not (yield converting(h1.t1, h2.t1, env)):
+            return False
+        if h1.name == h2.name:
+            return (yield converting(h1.t2, h2.t2, env))
+        fresh_name = Fresh.fresh()
+        return (
+            yield converting(
+                rename(h1.t2, h1.name, fresh_name),
+                rename(h2.t2, h2.name, fresh_name),
+                env,
+            )
+        )
+    raise fmtErrN_(h1, env, "not implemented yet")
+
+
+def all_converting(
+    us1: list[Term], us2: list[Term], env: Sequence[Definition]
+) -> Step[bool]:
+    # 対応する項がどれもβ・δ同値か（前から順に調べ、違えばそこでやめる）
+    for u1, u2 in zip(us1, us2):
+        if not (yield converting(u1, u2, env)):
+            return False
+    return True
+
+
+def spine(t: Term) -> Tuple[Term, list[Term]]:
+    # %(%(h)(u1))(u2) を h, [u1, u2] に分解する
+    args: list[Term] = []
+    while isinstance(t, AppTerm):
+        args.append(t.t2)
+        t = t.t1
+    args.reverse()
+    return t, args
+
+
+def whnf_beta(t: Term) -> Term:
+    # 頭のβ簡約だけを行い、弱頭部正規形にする（δ簡約はしない）
+    h, args = spine(t)
+    if not (isinstance(h, LambdaTerm) and args):
+        return t
+    i = 0
+    while isinstance(h, LambdaTerm) and i < len(args):
+        h, i = beta_reduction(h, args[i]), i + 1
+        if isinstance(h, AppTerm):
+            h, rest = spine(h)
+            args[i:i] = rest
+    for u in args[i:]:
+        h = AppTerm(h, u)
+    return h
+
+
+def unfolding_rank(h: Term, env: Sequence[Definition]) -> int:
+    # 頭hがδ簡約できる定数なら、環境でのその定義の位置を返す。できなければ-1
+    if not isinstance(h, ConstTerm):
+        return -1
+    found = lookup_definition(env, h.op)
+    if found is None:
+        raise fmtErrN_(h, env, "definition not found")
+    i, dfn = found
+    return -1 if dfn.is_prim else i
+
+
+def unfold_head(h: Term, args: list[Term], env: Sequence[Definition]) -> Term:
+    if not isinstance(h, ConstTerm):
+        raise fmtErrN_(h, env, "cannot unfold")
+    found = lookup_definition(env, h.op)
+    if found is None:
+        raise fmtErrN_(h, env, "definition not found")
+    t = delta_reduction(found[1], list(h.children))
+    for u in args:
+        t = AppTerm(t, u)
+    return t
+
+
+def add_common_arguments(apaser: argparse.ArgumentParser):
+    # check.py, derive.py, test.pyで共通の、実装を選ぶオプションと統計のオプション
+    apaser.add_argument(
+        "--engine", choices=substitution.ENGINES, default=substitution.ENGINE
+    )
+    apaser.add_argument("--normalizer", choices=NORMALIZERS, default=NORMALIZER)
+    apaser.add_argument("--conversion", choices=CONVERSIONS, default=CONVERSION)
+    apaser.add_argument(
+        "--nf-cache-size",
+        type=int,
+        default=NORMAL_FORMS.maxsize,
+        help="正規形キャッシュのエントリ数の上限（0でキャッシュしない）",
+    )
+    apaser.add_argument(
+        "--stats", action="store_true", help="終了時にキャッシュなどの統計を表示する"
+    )
+
+
+def set_common_options(args: argparse.Namespace):
+    substitution.set_engine(args.engine)
+    set_normalizer(args.normalizer)
+    set_conversion(args.conversion)
+    NORMAL_FORMS.resize(args.nf_cache_size)
+
+
+def print_stats(file=sys.stderr):
+    print(NORMAL_FORMS, file=file)
+    stats = Context.eq_stats
+    print(
+        f"context eq: {stats['identical']} identical, {stats['rejected']} rejected, "
+        f"{stats['walked']} walked ({stats['compared']} bindings compared)",
+        file=file,
+    )
 
 
 if __name__ == "__main__":
-    import argparse
+    from cache import ResultCache
 
     apaser = argparse.ArgumentParser(prog="verify")
     apaser.add_argument("filename")
+    apaser.add_argument(
+        "--debug", action="store_true", help="環境の一致を構造的にも比較する（遅い）"
+    )
+    apaser.add_argument(
+        "--stream",
+        action="store_true",
+        help="一行ずつ検査して結果をすぐに出力し、参照されなくなった判断を捨てる",
+    )
+    apaser.add_argument(
+        "--max-live",
+        action="store_true",
+        help="参照されなくなった判断を捨てたときに同時に持つ判断の数の最大値を表示する",
+    )
+    apaser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="def/defprで区切った区間を並列に検査するプロセスの数（1なら逐次）。"
+        "各区間は参照する定義の区間が通りしだい検査するので、互いに参照しない定義が多いほど速くなる",
+    )
+    apaser.add_argument(
+        "--cache",
+        metavar="DIRECTORY",
+        help="検査に通った区間をDIRECTORYに記録し、次からは同じ区間の検査を省く",
+    )
+    add_common_arguments(apaser)
     args = apaser.parse_args()
     filename = args.filename
+    Environment.debug = args.debug
+    set_common_options(args)
 
     def run():
-        with open(filename, "r") as f:
-            book: list[Judgement] = []
-            for line in f.readlines():
-                inst = scan_inst(line.replace("\n", ""))
-                book = check(inst, book)
-            return book
+        # テキスト形式でもバイナリ形式でも読む。
+        # 読んだ命令はInstructionArrayに溜めずに、一つずつ検査して捨てる。
+        # judgeは命令のオブジェクトで場合分けし、エラーにもその命令を載せるので、
+        # 配列に溜めても検査のときに結局オブジェクトを作ることになる
+        book: Book = Book()
+        for inst in binfmt.read_insts(filename):
+            book = check_book(inst, book)
+        return book
 
     # 今はまだ一瞬で終わる
     # import bench
     # print(f"{bench.repeat_sec(run, 10)} sec")
-    book = run()
-    for i, judgement in enumerate(book):
-        print(i, judgement)
+    if args.stream:
+        live_book = check_stream(filename)
+        if args.max_live:
+            print(f"max live: {live_book.max_live} / {len(live_book)}", file=sys.stderr)
+    else:
+        if args.jobs > 1 or args.cache is not None:
+            cache = None if args.cache is None else ResultCache(args.cache)
+            insts = list(binfmt.read_insts(filename))
+            book = check_segments(insts, args.jobs, cache)
+            if cache is not None and args.stats:
+                print(cache, file=sys.stderr)
+        else:
+            book = run()
+        for i, judgement in enumerate(book):
+            print(i, judgement)
+        if args.max_live:
+            array = InstructionArray(binfmt.read_insts(filename))
+            print(f"max live: {max_live(array)} / {len(book)}", file=sys.stderr)
+    if args.stats:
+        print_stats()
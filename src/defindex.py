@@ -0,0 +1,182 @@
+# defindex.py
+# def2の本（parse_definitionsで読んだ定義の列）の索引
+#
+# - 定数の名前から、定義の列での位置と定義への写像
+# - 依存関係のDAG: 各定義から、その文脈・本体・型に現れる定数の定義への辺
+# - 依存関係に沿った順序になっているかの検査と、その順序への並べ替え
+# - 循環、未定義の定数、同じ名前の定義の報告
+
+import heapq
+from typing import Iterator, Sequence, Tuple
+
+from check import Definition
+from parse import AppTerm, ConstTerm, LambdaTerm, PiTerm, Term
+
+
+class DefinitionIndexError(Exception):
+    pass
+
+
+def constants(t: Term) -> set[str]:
+    # 項に現れる定数の名前
+    ops: set[str] = set()
+    stack = [t]
+    while stack:
+        t = stack.pop()
+        if isinstance(t, ConstTerm):
+            ops.add(t.op)
+            stack.extend(t.children)
+        elif isinstance(t, AppTerm):
+            stack.append(t.t1)
+            stack.append(t.t2)
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            stack.append(t.t1)
+            stack.append(t.t2)
+    return ops
+
+
+def dependencies(dfn: Definition) -> set[str]:
+    # 定義の文脈、本体、型に現れる定数の名前
+    ops = constants(dfn.prop)
+    if not dfn.is_prim:
+        ops |= constants(dfn.body)
+    for tp in dfn.context.names_tps()[1]:
+        ops |= constants(tp)
+    return ops
+
+
+class DefinitionIndex:
+    """
+    定義の列の索引。
+    opsは定数の名前から（位置、定義）への写像で、同じ名前の定義が複数あれば最初のもの。
+    edges[i]はi番目の定義が参照する定数の定義の位置（昇順）。
+    missing[i]はi番目の定義が参照する定数のうち、どこにも定義されていないもの。
+    """
+
+    def __init__(self, dfns: Sequence[Definition]):
+        self.definitions = list(dfns)
+        self.ops: dict[str, Tuple[int, Definition]] = {}
+        self.duplicates: list[str] = []
+        for i, dfn in enumerate(self.definitions):
+            if dfn.op in self.ops:
+                self.duplicates.append(dfn.op)
+            else:
+                self.ops[dfn.op] = (i, dfn)
+        self.edges: list[list[int]] = []
+        self.missing: dict[int, list[str]] = {}
+        for i, dfn in enumerate(self.definitions):
+            deps = dependencies(dfn)
+            self.edges.append(sorted(self.ops[op][0] for op in deps if op in self.ops))
+            undefined = sorted(op for op in deps if op not in self.ops)
+            if undefined:
+                self.missing[i] = undefined
+
+    def __len__(self) -> int:
+        return len(self.definitions)
+
+    def __contains__(self, op: str) -> bool:
+        return op in self.ops
+
+    def __iter__(self) -> Iterator[Definition]:
+        return iter(self.definitions)
+
+    def lookup(self, op: str) -> Tuple[int, Definition] | None:
+        return self.ops.get(op)
+
+    def forward_references(self) -> dict[int, list[int]]:
+        # 自分より後ろ（か自分）の定義を参照している定義と、その参照先
+        return {
+            i: [j for j in edges if j >= i]
+            for i, edges in enumerate(self.edges)
+            if edges and edges[-1] >= i
+        }
+
+    def is_sorted(self) -> bool:
+        return not self.forward_references()
+
+    def cycles(self) -> list[list[int]]:
+        # 依存関係の循環（強連結成分のうち、大きさが2以上か自分を参照するもの）。
+        # Tarjanの方法を明示的なスタックで行う
+        order: dict[int, int] = {}
+        low: dict[int, int] = {}
+        stack: list[int] = []
+        on_stack: set[int] = set()
+        result: list[list[int]] = []
+        for root in range(len(self.definitions)):
+            if root in order:
+                continue
+            work = [(root, 0)]
+            while work:
+                v, k = work.pop()
+                if k == 0:
+                    order[v] = low[v] = len(order)
+                    stack.append(v)
+                    on_stack.add(v)
+                if k < len(self.edges[v]):
+                    work.append((v, k + 1))
+                    w = self.edges[v][k]
+                    if w not in order:
+                        work.append((w, 0))
+                    elif w in on_stack:
+                        low[v] = min(low[v], order[w])
+                    continue
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[v])
+                if low[v] == order[v]:
+                    component: list[int] = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component.append(w)
+                        if w == v:
+                            break
+                    if len(component) > 1 or v in self.edges[v]:
+                        result.append(sorted(component))
+        return sorted(result)
+
+    def topological_order(self) -> list[int]:
+        # 依存先が先に来る順序。そのような順序のうち、元の順序をなるべく保つもの
+        # （並べられる定義のうち、元の位置が一番小さいものから並べる）
+        waiting = [len(set(edges)) for edges in self.edges]
+        users: list[list[int]] = [[] for _ in self.definitions]
+        for i, edges in enumerate(self.edges):
+            for j in set(edges):
+                users[j].append(i)
+        ready = [i for i, n in enumerate(waiting) if n == 0]
+        heapq.heapify(ready)
+        order: list[int] = []
+        while ready:
+            j = heapq.heappop(ready)
+            order.append(j)
+            for i in users[j]:
+                waiting[i] -= 1
+                if waiting[i] == 0:
+                    heapq.heappush(ready, i)
+        if len(order) != len(self.definitions):
+            raise DefinitionIndexError(self.report())
+        return order
+
+    def sorted(self) -> "DefinitionIndex":
+        # 依存関係に沿って並べ替えた定義の列の索引。すでに沿っていれば自分を返す
+        if self.is_sorted():
+            return self
+        return DefinitionIndex([self.definitions[i] for i in self.topological_order()])
+
+    def report(self) -> str:
+        # 循環、未定義の定数、同じ名前の定義をまとめた報告。問題がなければ空文字列
+        lines: list[str] = []
+        for op in self.duplicates:
+            lines.append(f"constant {op} is defined more than once")
+        for i, ops in self.missing.items():
+            op = self.definitions[i].op
+            lines.append(f"{op} uses undefined constants: {', '.join(ops)}")
+        for cycle in self.cycles():
+            ops = [self.definitions[i].op for i in cycle]
+            lines.append(f"definitions depend on each other: {', '.join(ops)}")
+        return "\n".join(lines)
+
+    def validate(self):
+        report = self.report()
+        if report:
+            raise DefinitionIndexError(report)
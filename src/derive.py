@@ -1,5 +1,5 @@
 # automakeに対応
-# 定義の列は依存関係でトポロジカルソートされていると仮定する
+# 定義の列は、依存関係に沿って並んでいなければ並べ替えてから導出する（defindex.py）
 
 """
 上から定義を見ていって、
@@ -10,9 +10,24 @@ def, def-primに従ってデルタを拡張していく。
 
 import sys
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from typing import Tuple
 
-from check import Context, Definition, bd_eqv, normalize
+import check
+import subst as substitution
+import trampoline
+from check import (
+    EMPTY_ENV,
+    Context,
+    Definition,
+    Environment,
+    bd_eqv,
+    bd_normalize,
+    set_conversion,
+    set_normalizer,
+)
+from fresh_name import Fresh
 from inst import (
     AbstInst,
     ApplInst,
@@ -21,10 +36,12 @@ from inst import (
     EndInst,
     FormInst,
     InstInst,
-    Instruction,
+    InstructionArray,
     SortInst,
     VarInst,
     WeakInst,
+    rename_vars,
+    renumber,
 )
 from parse import (
     AppTerm,
@@ -37,7 +54,10 @@ from parse import (
     VarTerm,
     parse_term,
 )
-from subst import subst, subst_all
+from cache import FORMAT, ResultCache, definition_key, digest
+from defindex import DefinitionIndex, dependencies
+from subst import set_engine, subst, subst_many
+from trampoline import Step
 
 
 class DeriveError(Exception):
@@ -48,76 +68,158 @@ def fmtDeriveError(msg: str, term: Term) -> DeriveError:
     return DeriveError(f"{msg}\nterm: {term}")
 
 
-def prove_def(dfn: Definition, env: list[Definition], insts: list[Instruction]):
+def prove_def(dfn: Definition, env: Environment, insts: InstructionArray):
     # 単一の定義と、環境を受け取って定義本体の導出木を生成するinstの列を返す
     # 返すinstの行番号はindexからつけ始める
     index_for_sort = len(insts) - 1
+    memo: ProofMemo = {}
     if dfn.is_prim:
-        prop, pr_index = prove_term(env, dfn.context, dfn.prop, insts, index_for_sort)
+        prop, pr_index = prove_term(
+            env, dfn.context, dfn.prop, insts, index_for_sort, memo
+        )
         if not is_s(prop):
             raise fmtDeriveError("must be sort for prim def", dfn.prop)
         insts.append(DefInst(len(insts), index_for_sort, pr_index, dfn.op))
     else:
-        prop, pr_index = prove_term(env, dfn.context, dfn.body, insts, index_for_sort)
+        prop, pr_index = prove_term(
+            env, dfn.context, dfn.body, insts, index_for_sort, memo
+        )
         if not check_abd_eqv(prop, dfn.prop, env):
             print(f"{prop=}\n{dfn=}", file=sys.stderr)
             raise fmtDeriveError("fail to derive expected property", dfn.prop)
         insts.append(DefInst(len(insts), index_for_sort, pr_index, dfn.op))
 
 
-def check_abd_eqv(t1: Term, t2: Term, env: list[Definition]) -> bool:
+def check_abd_eqv(t1: Term, t2: Term, env: Environment) -> bool:
     return t1 == t2 or bd_eqv(t1, t2, env)
 
 
-def assert_index(insts: list[Instruction], base: int, actual: int):
+def assert_index(insts: InstructionArray, base: int, actual: int):
     if not base + len(insts) == actual:
         raise Exception(f"insts len: {len(insts)}\n{base=}\n{actual=}")
 
 
 def prove_normalize(
-    env: list[Definition],
+    env: Environment,
     ctx: Context,
     tp: Term,
     pr_index_t: int,
-    insts: list[Instruction],  # このリストを破壊的に変更することに注意
+    insts: InstructionArray,  # この命令列を破壊的に変更することに注意
     index_for_sort: int,
-) -> Tuple[Term, int]:
+    memo: "ProofMemo",
+) -> Step[Tuple[Term, int]]:
     "tの正規形とそれを示したインデックスを返す。そのために必要な命令をinstsにアペンドする"
-    n = normalize(tp, env)
-    s, pr_index_n = prove_term(env, ctx, n, insts, index_for_sort)
+    n = bd_normalize(tp, env)
+    s, pr_index_n = yield proving(env, ctx, n, insts, index_for_sort, memo)
     if not is_s(s):
         raise fmtDeriveError("conv cannot prove equivalence of non-type", tp)
     insts.append(ConvInst(len(insts), pr_index_t, pr_index_n))
     return n, len(insts) - 1
 
 
+# Falseにすると、同じ判断も毎回導出し直す（比較用）
+SHARING = True
+
+# 一つのprove_defの中で示した判断の表。(文脈のid, 項のid) から (文脈, 項, 命題, インデックス)。
+# 文脈も項もinternされているので、同じ判断は同じキーになる。
+# idが使い回されないように、文脈と項も持っておく
+ProofMemo = dict[Tuple[int, int], Tuple[Context, Term, Term, int]]
+
+
 def prove_term(
-    env: list[Definition],
+    env: Environment,
     ctx: Context,
     t: Term,
-    insts: list[Instruction],  # このリストを破壊的に変更することに注意
+    insts: InstructionArray,  # この命令列を破壊的に変更することに注意
     index_for_sort: int,
+    memo: ProofMemo | None = None,
 ) -> Tuple[Term, int]:
     # 返すのは
-    #   証明列、示した命題、命題を示したインデックス
+    #   示した命題、命題を示したインデックス
+    # memoにすでにある判断は、命令を足さずにそのインデックスを返す（証明木をDAGにする）。
+    # 深い項でも再帰しないように、provingをtrampolineで実行する
+    if memo is None:
+        memo = {}
+    return trampoline.run(proving(env, ctx, t, insts, index_for_sort, memo))
+
+
+def proving(
+    env: Environment,
+    ctx: Context,
+    t: Term,
+    insts: InstructionArray,  # この命令列を破壊的に変更することに注意
+    index_for_sort: int,
+    memo: ProofMemo,
+) -> Step[Tuple[Term, int]]:
+    # prove_termの本体。部分項の証明はyieldして求める
+    if not SHARING:
+        return (yield prove_term_by_rule(env, ctx, t, insts, index_for_sort, memo))
+    key = (id(ctx), id(t))
+    hit = memo.get(key)
+    if hit is not None:
+        return hit[2], hit[3]
+    prop, index = yield prove_term_by_rule(env, ctx, t, insts, index_for_sort, memo)
+    memo[key] = (ctx, t, prop, index)
+    return prop, index
+
+
+def prove_weakened(
+    env: Environment,
+    ctx: Context,
+    t: Term,
+    insts: InstructionArray,  # この命令列を破壊的に変更することに注意
+    index_for_sort: int,
+    memo: ProofMemo,
+) -> Step[Tuple[Term, int]]:
+    # tが*か変数のとき、weakを使ってtを示す。
+    # 文脈を後ろから遡り、tを直接示せる接頭辞かmemoにある接頭辞を見つけて、そこから
+    # 残りの束縛をweakで一つずつ足していく。束縛の型の証明もmemoから引くので、
+    # 接頭辞ごとの判断は一度しか作られず、同じ変数をもう一度使うときは命令が増えない。
+    # 再帰せずに遡るので、長い文脈でも再帰が深くならない
+    chain: list[Context] = []
+    c = ctx
+    while not (SHARING and (id(c), id(t)) in memo) and not provable_directly(c, t):
+        chain.append(c)
+        head = c.get_ahead()
+        if head is None:
+            raise fmtDeriveError("ctx too short", t)
+        c = head
+    prop, pr_index = yield proving(env, c, t, insts, index_for_sort, memo)
+    for c in reversed(chain):
+        name, tp = c.car()
+        prop2, pr_index2 = yield proving(env, c.cdr(), tp, insts, index_for_sort, memo)
+        if not is_s(prop2):
+            raise fmtDeriveError("must be a sort", tp)
+        insts.append(WeakInst(len(insts), pr_index, pr_index2, name))
+        pr_index = len(insts) - 1
+        if SHARING:
+            memo[(id(c), id(t))] = (c, t, prop, pr_index)
+    return prop, pr_index
+
+
+def provable_directly(ctx: Context, t: Term) -> bool:
+    # weakを使わずにtを示せるか（*なら空の文脈、変数なら最後の束縛）
+    if isinstance(t, StarTerm):
+        return ctx.is_empty
+    return isinstance(t, VarTerm) and not ctx.is_empty and ctx.car()[0] == t.name
+
+
+def prove_term_by_rule(
+    env: Environment,
+    ctx: Context,
+    t: Term,
+    insts: InstructionArray,  # この命令列を破壊的に変更することに注意
+    index_for_sort: int,
+    memo: ProofMemo,
+) -> Step[Tuple[Term, int]]:
+    # tの形に応じた規則で、tを示す命令をinstsにアペンドする
     match t:
         case SortTerm():
             raise fmtDeriveError("sort cannot be typed", t)
         case StarTerm():
             if ctx.is_empty:
                 return SortTerm(), index_for_sort
-            else:
-                mb_tuple = ctx.get_last()
-                if not mb_tuple:
-                    raise fmtDeriveError("internal", t)
-                name, tp = mb_tuple
-                head = ctx.get_ahead()
-                if not head:
-                    raise fmtDeriveError("internal", t)
-                prop1, pr_index1 = prove_term(env, head, t, insts, index_for_sort)
-                prop2, pr_index2 = prove_term(env, head, tp, insts, index_for_sort)
-                insts.append(WeakInst(len(insts), pr_index1, pr_index2, name))
-                return prop1, len(insts) - 1
+            return (yield prove_weakened(env, ctx, t, insts, index_for_sort, memo))
         case VarTerm():
             mb_tuple = ctx.get_last()
             if not mb_tuple:
@@ -125,45 +227,41 @@ def prove_term(
             name, tp = mb_tuple
             if name != t.name:
                 # use (weak)
-                head = ctx.get_ahead()
-                if not head:
-                    raise fmtDeriveError("ctx too short", t)
-                prop1, pr_index1 = prove_term(env, head, t, insts, index_for_sort)
-                prop2, pr_index2 = prove_term(env, head, tp, insts, index_for_sort)
-                if not is_s(prop2):
-                    raise fmtDeriveError("must be a sort", tp)
-                insts.append(WeakInst(len(insts), pr_index1, pr_index2, name))
-                return prop1, len(insts) - 1
+                if ctx.get(t.name) is None:
+                    raise fmtDeriveError("no binding found", t)
+                return (yield prove_weakened(env, ctx, t, insts, index_for_sort, memo))
             else:
                 mb_ctx = ctx.get_ahead()
                 if not mb_ctx:
                     raise fmtDeriveError("empty ctx", t)
                 else:
-                    prop, pr_index = prove_term(env, mb_ctx, tp, insts, index_for_sort)
+                    prop, pr_index = yield proving(
+                        env, mb_ctx, tp, insts, index_for_sort, memo
+                    )
                     if not is_s(prop):
                         raise fmtDeriveError("must be a sort", tp)
                     insts.append(VarInst(len(insts), pr_index, t))
                     return tp, len(insts) - 1
         case AppTerm(t1, t2):
-            prop1, pr_index1 = prove_term(env, ctx, t1, insts, index_for_sort)
-            prop2, pr_index2 = prove_term(env, ctx, t2, insts, index_for_sort)
+            prop1, pr_index1 = yield proving(env, ctx, t1, insts, index_for_sort, memo)
+            prop2, pr_index2 = yield proving(env, ctx, t2, insts, index_for_sort, memo)
 
             # prop1がPiであることを保証
             if not isinstance(prop1, PiTerm):
-                prop1, pr_index1 = prove_normalize(
-                    env, ctx, prop1, pr_index1, insts, index_for_sort
+                prop1, pr_index1 = yield prove_normalize(
+                    env, ctx, prop1, pr_index1, insts, index_for_sort, memo
                 )
                 if not isinstance(prop1, PiTerm):
                     raise fmtDeriveError("must have Pi term", t1)
 
             # prop1.t1 = prop2を保証
             if prop1.t1 != prop2:
-                prop2, pr_index2 = prove_normalize(
-                    env, ctx, prop2, pr_index2, insts, index_for_sort
+                prop2, pr_index2 = yield prove_normalize(
+                    env, ctx, prop2, pr_index2, insts, index_for_sort, memo
                 )
                 if prop1.t1 != prop2:
-                    prop1, pr_index1 = prove_normalize(
-                        env, ctx, prop1, pr_index1, insts, index_for_sort
+                    prop1, pr_index1 = yield prove_normalize(
+                        env, ctx, prop1, pr_index1, insts, index_for_sort, memo
                     )
                     if not isinstance(prop1, PiTerm):
                         # 静的解析の都合で検査
@@ -177,40 +275,49 @@ def prove_term(
             return subst(prop1.t2, t2, prop1.name), len(insts) - 1
         case LambdaTerm(t1, t2, name):
             # prop1 = B
-            prop1, pr_index1 = prove_term(
-                env, ctx.extend(name, t1), t2, insts, index_for_sort
+            prop1, pr_index1 = yield proving(
+                env, ctx.extend(name, t1), t2, insts, index_for_sort, memo
             )
             # prop = Pi type of t
             prop = PiTerm(t1, prop1, name)
-            prop2, pr_index2 = prove_term(env, ctx, prop, insts, index_for_sort)
+            prop2, pr_index2 = yield proving(
+                env, ctx, prop, insts, index_for_sort, memo
+            )
             if not is_s(prop2):
                 raise fmtDeriveError("must be a sort", prop2)
             insts.append(AbstInst(len(insts), pr_index1, pr_index2))
             return prop, len(insts) - 1
         case ConstTerm(op, children):
-            prop1, pr_index1 = prove_term(env, ctx, StarTerm(), insts, index_for_sort)
+            prop1, pr_index1 = yield proving(
+                env, ctx, StarTerm(), insts, index_for_sort, memo
+            )
             if not isinstance(prop1, SortTerm):
                 raise fmtDeriveError("must be sort", prop1)
-            dfn_i, dfn = next((i, dfn) for (i, dfn) in enumerate(env) if dfn.op == op)
+            found = env.lookup(op)
+            if found is None:
+                raise fmtDeriveError("definition not found", t)
+            dfn_i, dfn = found
             pres: list[int] = []
             names, tps = dfn.context.names_tps()
+            sbst: dict[str, Term] = {}
             for i, u in enumerate(children):
-                prop_u, pr_index_u = prove_term(env, ctx, u, insts, index_for_sort)
+                prop_u, pr_index_u = yield proving(
+                    env, ctx, u, insts, index_for_sort, memo
+                )
                 pres.append(pr_index_u)
-                if not check_abd_eqv(
-                    prop_u, subst_all(tps[i], names[:i], children[:i]), env
-                ):
+                if not check_abd_eqv(prop_u, subst_many(tps[i], sbst), env):
                     raise fmtDeriveError("type not matched", t)
+                sbst[names[i]] = u
             insts.append(
-                InstInst(len(insts), pr_index1, len(dfn.context.container), pres, dfn_i)
+                InstInst(len(insts), pr_index1, dfn.context.size, pres, dfn_i)
             )
-            return subst_all(dfn.prop, names, children), len(insts) - 1
+            return subst_many(dfn.prop, sbst), len(insts) - 1
         case PiTerm(t1, t2, name):
-            prop1, pr_index1 = prove_term(env, ctx, t1, insts, index_for_sort)
+            prop1, pr_index1 = yield proving(env, ctx, t1, insts, index_for_sort, memo)
             if not is_s(prop1):
                 raise fmtDeriveError("must be a sort", t1)
-            prop2, pr_index2 = prove_term(
-                env, ctx.extend(name, t1), t2, insts, index_for_sort
+            prop2, pr_index2 = yield proving(
+                env, ctx.extend(name, t1), t2, insts, index_for_sort, memo
             )
             if not is_s(prop2):
                 raise fmtDeriveError("must be a sort", t2)
@@ -281,7 +388,8 @@ def parse_script(lines: list[str]) -> Definition:
     return Definition(op, Context(binds), m, n, is_prim=prim_flag)
 
 
-def derive_lines(lines: list[str]) -> list[Instruction]:
+def parse_definitions(lines: list[str]) -> list[Definition]:
+    # def2形式のファイルの各行（改行を含む）を、定義の列に変換する
     dfn_scripts: list[list[str]] = []
     dfn_script: list[str] = []
     for line in lines:
@@ -299,17 +407,152 @@ def derive_lines(lines: list[str]) -> list[Instruction]:
             traceback.print_exc()
             print(f"parse error at: {ds=}", file=sys.stderr)
             exit(1)
-    instructions: list[Instruction] = [SortInst(0)]
+    return dfns
+
+
+def derive_lines(
+    lines: list[str], jobs: int = 1, cache: ResultCache | None = None
+) -> InstructionArray:
+    # jobsが2以上なら、定義ごとの導出をプロセスプールで並列に行う。
+    # cacheを渡すと、前に導出した断片（鍵が同じもの）を使い回す
+    dfns = ordered_definitions(parse_definitions(lines))
+    if jobs > 1 or cache is not None:
+        return derive_fragments(dfns, jobs, cache)
+    instructions = InstructionArray([SortInst(0)])
+    env = EMPTY_ENV
     for i, dfn in enumerate(dfns):
         try:
-            prove_def(dfn, dfns[:i], instructions)
+            prove_def(dfn, env, instructions)
         except DeriveError as e:
             for inst in instructions:
                 print(inst)
             traceback.print_exc()
             print(f"derivation error at: {dfn}", file=sys.stderr)
             raise e
-        print(f"derive {i}")
+        env = env.extend(dfn)
+        print(f"derive {i}", file=sys.stderr)
+    instructions.append(EndInst(-1))
+    return instructions
+
+
+def ordered_definitions(dfns: list[Definition]) -> list[Definition]:
+    # 循環や未定義の定数があれば、導出を始める前にまとめて報告する。
+    # 依存関係に沿って並んでいなければ、元の順序をなるべく保って並べ替える
+    index = DefinitionIndex(dfns)
+    index.validate()
+    if not index.is_sorted():
+        moved = sorted(index.definitions[i].op for i in index.forward_references())
+        print(f"reorder definitions: {', '.join(moved)}", file=sys.stderr)
+        index = index.sorted()
+    return index.definitions
+
+
+"""
+# 並列導出
+
+定義の導出に使う環境は、それより前の定義（導出した結果ではなく、書かれた定義）を並べたものなので、
+各定義の導出は他の定義の導出を待たずに始められる。
+定義の列はordered_definitionsで依存関係に沿って並べてある。
+
+各定義は、0番を「直前の定義までの環境で * : @ を示した判断」とする断片として導出する。
+断片の命令はprove_defがそのまま作るので、逐次の導出と同じ命令が同じ順に並ぶ。
+断片を順につなぐときに、行番号と前提の番号に（つなぐ時点の命令数 - 1）を足せば、
+0番が直前の定義の判断（def命令）を指すようになる。
+フレッシュな変数名（^N）はプロセスごとに数えるので、別のワーカーやキャッシュから来た断片どうしで
+同じ名前になりうるし、つなぐプロセスがこれから生成する名前とも衝突しうる。
+そこで断片をつなぐときに、断片のフレッシュな名前をつなぐプロセスで生成し直した名前に付け替える。
+こうすると断片ごとに名前が重ならず、つないだ命令列をそのまま同じプロセスで検査してもよい。
+番号だけは逐次の導出と異なりうる。
+
+断片は定義と、それが参照する定数（の定義と環境での位置）だけで決まるので、
+それらから求めた鍵で結果のキャッシュ（cache.py）に保存しておけば、
+定義を書き換えたときには、その定義とそれを参照する定義だけを導出し直せばよい。
+"""
+
+
+# ワーカープロセスごとの状態。_envs[i]はi番目の定義を導出するときの環境
+_envs: list[Environment] = []
+_dfns: list[Definition] = []
+
+
+def _init_worker(dfns: list[Definition], options: Tuple[str, str, str, int, bool]):
+    global _envs, _dfns, SHARING
+    engine, normalizer, conversion, nf_cache_size, SHARING = options
+    set_engine(engine)
+    set_normalizer(normalizer)
+    set_conversion(conversion)
+    check.NORMAL_FORMS.resize(nf_cache_size)
+    _dfns = dfns
+    _envs = []
+    env = EMPTY_ENV
+    for dfn in dfns:
+        _envs.append(env)
+        env = env.extend(dfn)
+
+
+def _derive_fragment(i: int) -> InstructionArray:
+    fragment = InstructionArray([SortInst(0)])  # 0番は直前の定義の判断の代わり
+    prove_def(_dfns[i], _envs[i], fragment)
+    return fragment
+
+
+def fragment_keys(dfns: list[Definition]) -> list[str]:
+    # 断片の鍵。定義の内容と、参照する定数の環境での位置と鍵から求める
+    keys: dict[str, str] = {}
+    positions: dict[str, int] = {}
+    result: list[str] = []
+    for i, dfn in enumerate(dfns):
+        parts = [FORMAT, "sharing" if SHARING else "", definition_key(dfn)]
+        for op in sorted(dependencies(dfn)):
+            parts += [op, str(positions[op]), keys[op]]
+        key = digest(parts)
+        keys[dfn.op] = key
+        positions[dfn.op] = i
+        result.append(key)
+    return result
+
+
+def derive_fragments(
+    dfns: list[Definition], jobs: int = 1, cache: ResultCache | None = None
+) -> InstructionArray:
+    options = (
+        substitution.ENGINE,
+        check.NORMALIZER,
+        check.CONVERSION,
+        check.NORMAL_FORMS.maxsize,
+        SHARING,
+    )
+    fragments: list[InstructionArray | None] = [None] * len(dfns)
+    keys: list[str] = []
+    if cache is not None:
+        keys = fragment_keys(dfns)
+        fragments = [cache.get_fragment(key) for key in keys]
+    todo = [i for i, fragment in enumerate(fragments) if fragment is None]
+
+    with ExitStack() as stack:
+        if jobs > 1 and len(todo) > 1:
+            pool = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=jobs, initializer=_init_worker, initargs=(dfns, options)
+                )
+            )
+            derived = pool.map(_derive_fragment, todo)
+        else:
+            _init_worker(dfns, options)
+            derived = map(_derive_fragment, todo)
+
+        instructions = InstructionArray([SortInst(0)])
+        for i, fragment in enumerate(fragments):
+            if fragment is None:
+                fragment = next(derived)
+                if cache is not None:
+                    cache.put_fragment(keys[i], fragment)
+            offset = len(instructions) - 1
+            names = {n: Fresh.fresh() for n in fragment.names if Fresh.is_fresh(n)}
+            for inst in fragment[1:]:
+                inst = rename_vars(inst, names)
+                instructions.append(renumber(inst, lambda i: i + offset))
+            print(f"derive {i}", file=sys.stderr)
     instructions.append(EndInst(-1))
     return instructions
 
@@ -317,13 +560,44 @@ def derive_lines(lines: list[str]) -> list[Instruction]:
 if __name__ == "__main__":
     import argparse
 
+    from check import add_common_arguments, print_stats, set_common_options
+
     apaser = argparse.ArgumentParser(prog="automake")
     apaser.add_argument("filename")
+    apaser.add_argument(
+        "--binary",
+        metavar="OUTPUT",
+        help="命令列を標準出力ではなく、バイナリ形式でOUTPUTに書く",
+    )
+    apaser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="定義ごとの導出を並列に行うプロセスの数（1なら逐次）",
+    )
+    apaser.add_argument(
+        "--cache",
+        metavar="DIRECTORY",
+        help="導出した断片をDIRECTORYに保存し、次からは変わっていない定義の導出を省く",
+    )
+    add_common_arguments(apaser)
     args = apaser.parse_args()
     filename = args.filename
+    set_common_options(args)
 
     with open(filename, "r") as f:
         lines = f.readlines()
-    instructions = derive_lines(lines)
-    for inst in instructions:
-        print(inst)
+    cache = None if args.cache is None else ResultCache(args.cache)
+    instructions = derive_lines(lines, args.jobs, cache)
+    if args.binary is not None:
+        from binfmt import write_binary
+
+        with open(args.binary, "wb") as out:
+            write_binary(instructions, out)
+    else:
+        for inst in instructions:
+            print(inst)
+    if args.stats:
+        print_stats()
+        if cache is not None:
+            print(cache, file=sys.stderr)
@@ -1,6 +1,7 @@
 class Fresh:
     # フレッシュな変数名を生成する
-    # ユーザからの入力では、イプシロンの定義から#で始まる変数名は生成され得ないため衝突しない
+    # 生成する名前は^で始まる。命令列（テキスト形式でもバイナリ形式でも）はderiveが生成した
+    # ^Nの名前を持ち得るので、読むときにreserveで番号をNより先に進めて衝突を避ける
     # 内部処理では、このクラス経由でしか変数名を生成しなければ衝突しない
     __gen = 0
     @staticmethod
@@ -8,3 +9,20 @@ class Fresh:
         num = Fresh.__gen
         Fresh.__gen += 1
         return f"^{num}"
+    @staticmethod
+    def count() -> int:
+        # これまでに生成した名前の数
+        return Fresh.__gen
+    @staticmethod
+    def advance(n: int):
+        # 別のプロセスで生成した名前と衝突しないように、番号をn以上に進める
+        Fresh.__gen = max(Fresh.__gen, n)
+    @staticmethod
+    def is_fresh(name: str) -> bool:
+        # このクラスが生成する形（^N）の名前か
+        return name.startswith("^") and name[1:].isdigit()
+    @staticmethod
+    def reserve(name: str):
+        # 外から読んだ名前nameが^Nなら、これから生成する名前がそれと衝突しないように進める
+        if Fresh.is_fresh(name):
+            Fresh.advance(int(name[1:]) + 1)
@@ -1,27 +1,32 @@
+import re
+from array import array
 from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, overload
 
-from parse import VarTerm, parse_term
+from fresh_name import Fresh
+from parse import VarTerm
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Instruction:
+    # 命令はどれもスロットを持つ小さなオブジェクト。
+    # 長い命令列はInstructionArrayに列ごとの配列として持ち、必要なときだけ命令を作る
     lnum: int
-    pass
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class EndInst(Instruction):
     def __str__(self):
         return f"{self.lnum}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SortInst(Instruction):
     def __str__(self) -> str:
         return f"{self.lnum} sort"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class VarInst(Instruction):
     pre: int
     var: VarTerm
@@ -29,7 +34,7 @@ class VarInst(Instruction):
         return f"{self.lnum} var {self.pre} {self.var}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class WeakInst(Instruction):
     pre1: int
     pre2: int
@@ -38,7 +43,7 @@ class WeakInst(Instruction):
         return f"{self.lnum} weak {self.pre1} {self.pre2} {self.var}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class FormInst(Instruction):
     pre1: int
     pre2: int
@@ -46,7 +51,7 @@ class FormInst(Instruction):
         return f"{self.lnum} form {self.pre1} {self.pre2}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ApplInst(Instruction):
     pre1: int
     pre2: int
@@ -54,7 +59,7 @@ class ApplInst(Instruction):
         return f"{self.lnum} appl {self.pre1} {self.pre2}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbstInst(Instruction):
     pre1: int
     pre2: int
@@ -62,7 +67,7 @@ class AbstInst(Instruction):
         return f"{self.lnum} abst {self.pre1} {self.pre2}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DefInst(Instruction):
     pre1: int
     pre2: int
@@ -71,7 +76,7 @@ class DefInst(Instruction):
         return f"{self.lnum} def {self.pre1} {self.pre2} {self.op}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DefPrInst(Instruction):
     pre1: int
     pre2: int
@@ -81,7 +86,7 @@ class DefPrInst(Instruction):
 
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class InstInst(Instruction):
     # instantiation instruction
     pre: int
@@ -89,26 +94,212 @@ class InstInst(Instruction):
     pres: list[int]
     op_offset: int
     def __str__(self) -> str:
-        return f"{self.lnum} inst {self.pre} {self.length} {' '.join(map(lambda x: x.__str__(), self.pres))} {self.op_offset}"
+        tokens = [self.pre, self.length, *self.pres, self.op_offset]
+        return f"{self.lnum} inst {' '.join(map(lambda x: x.__str__(), tokens))}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ConvInst(Instruction):
     pre1: int
     pre2: int
     def __str__(self) -> str:
-        return f"{self.lnum} {self.pre1} {self.pre2}"
+        return f"{self.lnum} conv {self.pre1} {self.pre2}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class CPInst(Instruction):
     target: int
+    def __str__(self) -> str:
+        return f"{self.lnum} cp {self.target}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SPInst(Instruction):
     target: int
     bind: int
+    def __str__(self) -> str:
+        return f"{self.lnum} sp {self.target} {self.bind}"
+
+
+# オペコード（InstructionArrayとbinfmt.pyで使う）
+OP_SORT = 0
+OP_END = 1
+OP_VAR = 2
+OP_WEAK = 3
+OP_FORM = 4
+OP_APPL = 5
+OP_ABST = 6
+OP_CONV = 7
+OP_DEF = 8
+OP_DEFPR = 9
+OP_INST = 10
+OP_CP = 11
+OP_SP = 12
+
+# オペランドが前提の番号二つだけの命令
+PairInst = FormInst | ApplInst | AbstInst | ConvInst
+
+_PAIRS: dict[type[PairInst], int] = {
+    FormInst: OP_FORM,
+    ApplInst: OP_APPL,
+    AbstInst: OP_ABST,
+    ConvInst: OP_CONV,
+}
+_PAIR_CLASSES = {op: cls for cls, op in _PAIRS.items()}
+
+
+class InstructionArray:
+    """
+    命令列を、命令ごとのオブジェクトではなく列ごとの配列（struct of arrays）で持つ。
+    ops: オペコード、lnums: 行番号、args1〜args3: オペランド。
+    オペランドの意味はオペコードごとに決まっていて、使わない列には0を入れる。
+      var:  pre, -, 名前    weak: pre1, pre2, 名前   def, defpr: pre1, pre2, 名前
+      form, appl, abst, conv: pre1, pre2, -      cp: target, -, -    sp: target, bind, -
+      inst: pre, length, op_offset（presはpresに平らに並べ、pres_start[i]から始まる）
+    名前（変数名と定数名）はnamesに一度だけ入れて番号で指す。
+    インデックスで取り出すと、その命令のオブジェクトを作って返す。
+    """
+
+    __slots__ = (
+        "ops",
+        "lnums",
+        "args1",
+        "args2",
+        "args3",
+        "pres",
+        "pres_start",
+        "names",
+        "name_ids",
+    )
+
+    def __init__(self, insts: Iterable[Instruction] = ()):
+        self.ops = array("B")
+        self.lnums = array("q")
+        self.args1 = array("q")
+        self.args2 = array("q")
+        self.args3 = array("q")
+        self.pres = array("q")
+        self.pres_start = array("q", [0])
+        self.names: list[str] = []
+        self.name_ids: dict[str, int] = {}
+        self.extend(insts)
+
+    def name_id(self, name: str) -> int:
+        i = self.name_ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.name_ids[name] = i
+            self.names.append(name)
+        return i
+
+    def _push(self, op: int, lnum: int, a1: int = 0, a2: int = 0, a3: int = 0):
+        self.ops.append(op)
+        self.lnums.append(lnum)
+        self.args1.append(a1)
+        self.args2.append(a2)
+        self.args3.append(a3)
+        self.pres_start.append(len(self.pres))
+
+    def append(self, inst: Instruction):
+        if isinstance(inst, (FormInst, ApplInst, AbstInst, ConvInst)):
+            self._push(_PAIRS[type(inst)], inst.lnum, inst.pre1, inst.pre2)
+            return
+        match inst:
+            case SortInst(lnum):
+                self._push(OP_SORT, lnum)
+            case EndInst(lnum):
+                self._push(OP_END, lnum)
+            case VarInst(lnum, pre, var):
+                self._push(OP_VAR, lnum, pre, 0, self.name_id(var.name))
+            case WeakInst(lnum, pre1, pre2, var):
+                self._push(OP_WEAK, lnum, pre1, pre2, self.name_id(var))
+            case DefInst(lnum, pre1, pre2, op):
+                self._push(OP_DEF, lnum, pre1, pre2, self.name_id(op))
+            case DefPrInst(lnum, pre1, pre2, op):
+                self._push(OP_DEFPR, lnum, pre1, pre2, self.name_id(op))
+            case InstInst(lnum, pre, length, pres, op_offset):
+                self.pres.extend(pres)
+                self._push(OP_INST, lnum, pre, length, op_offset)
+            case CPInst(lnum, target):
+                self._push(OP_CP, lnum, target)
+            case SPInst(lnum, target, bind):
+                self._push(OP_SP, lnum, target, bind)
+            case _:
+                raise FormatError(f"cannot store: {inst}")
+
+    def extend(self, insts: Iterable[Instruction]):
+        for inst in insts:
+            self.append(inst)
+
+    def __len__(self) -> int:
+        return len(self.ops)
+
+    @overload
+    def __getitem__(self, i: int) -> Instruction:
+        ...
+
+    @overload
+    def __getitem__(self, i: slice) -> list[Instruction]:
+        ...
+
+    def __getitem__(self, i: int | slice) -> Instruction | list[Instruction]:
+        if isinstance(i, slice):
+            return [self.view(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("InstructionArray index out of range")
+        return self.view(i)
+
+    def __iter__(self) -> Iterator[Instruction]:
+        for i in range(len(self)):
+            yield self.view(i)
+
+    def view(self, i: int) -> Instruction:
+        # i番目の命令のオブジェクトを作る
+        op = self.ops[i]
+        lnum = self.lnums[i]
+        cls = _PAIR_CLASSES.get(op)
+        if cls is not None:
+            return cls(lnum, self.args1[i], self.args2[i])
+        if op == OP_SORT:
+            return SortInst(lnum)
+        elif op == OP_END:
+            return EndInst(lnum)
+        elif op == OP_VAR:
+            return VarInst(lnum, self.args1[i], VarTerm(self.names[self.args3[i]]))
+        elif op == OP_WEAK:
+            a1, a2, a3 = self.args1[i], self.args2[i], self.args3[i]
+            return WeakInst(lnum, a1, a2, self.names[a3])
+        elif op == OP_DEF:
+            a1, a2, a3 = self.args1[i], self.args2[i], self.args3[i]
+            return DefInst(lnum, a1, a2, self.names[a3])
+        elif op == OP_DEFPR:
+            a1, a2, a3 = self.args1[i], self.args2[i], self.args3[i]
+            return DefPrInst(lnum, a1, a2, self.names[a3])
+        elif op == OP_INST:
+            pres = self.pres[self.pres_start[i] : self.pres_start[i + 1]].tolist()
+            return InstInst(lnum, self.args1[i], self.args2[i], pres, self.args3[i])
+        elif op == OP_CP:
+            return CPInst(lnum, self.args1[i])
+        elif op == OP_SP:
+            return SPInst(lnum, self.args1[i], self.args2[i])
+        raise FormatError(f"unknown opcode {op}")
+
+    def premises(self, i: int) -> list[int]:
+        # i番目の命令が参照する判断の番号。命令のオブジェクトを作らずに求める
+        op = self.ops[i]
+        if op in _PAIR_CLASSES or op in (OP_WEAK, OP_DEF, OP_DEFPR):
+            return [self.args1[i], self.args2[i]]
+        elif op in (OP_VAR, OP_CP, OP_SP):
+            return [self.args1[i]]
+        elif op == OP_INST:
+            pres = self.pres[self.pres_start[i] : self.pres_start[i + 1]]
+            return [self.args1[i], *pres]
+        return []
+
+    def all_premises(self) -> Iterator[list[int]]:
+        return map(self.premises, range(len(self)))
 
 
 class FormatError(Exception):
@@ -119,6 +310,111 @@ def __fmtErr(lnum: int, badcode: str = "", msg: str = "") -> FormatError:
     return FormatError(f"at {lnum}: `{badcode}`\n{msg}")
 
 
+def premises(inst: Instruction) -> list[int]:
+    # instが参照する判断の番号
+    match inst:
+        case VarInst(_lnum, pre) | CPInst(_lnum, pre) | SPInst(_lnum, pre):
+            return [pre]
+        case InstInst(_lnum, pre, _length, pres):
+            return [pre, *pres]
+        case (
+            WeakInst(_lnum, pre1, pre2)
+            | FormInst(_lnum, pre1, pre2)
+            | ApplInst(_lnum, pre1, pre2)
+            | AbstInst(_lnum, pre1, pre2)
+            | DefInst(_lnum, pre1, pre2)
+            | DefPrInst(_lnum, pre1, pre2)
+            | ConvInst(_lnum, pre1, pre2)
+        ):
+            return [pre1, pre2]
+        case _:
+            return []
+
+
+def renumber(inst: Instruction, f: Callable[[int], int]) -> Instruction:
+    # 行番号と参照する判断の番号をfで付け替えた命令
+    match inst:
+        case SortInst(lnum):
+            return SortInst(f(lnum))
+        case EndInst(lnum):
+            return inst if lnum < 0 else EndInst(f(lnum))
+        case VarInst(lnum, pre, var):
+            return VarInst(f(lnum), f(pre), var)
+        case WeakInst(lnum, pre1, pre2, var):
+            return WeakInst(f(lnum), f(pre1), f(pre2), var)
+        case DefInst(lnum, pre1, pre2, op):
+            return DefInst(f(lnum), f(pre1), f(pre2), op)
+        case DefPrInst(lnum, pre1, pre2, op):
+            return DefPrInst(f(lnum), f(pre1), f(pre2), op)
+        case InstInst(lnum, pre, length, pres, op_offset):
+            return InstInst(f(lnum), f(pre), length, list(map(f, pres)), op_offset)
+        case CPInst(lnum, target):
+            return CPInst(f(lnum), f(target))
+        case SPInst(lnum, target, bind):
+            return SPInst(f(lnum), f(target), bind)
+        case FormInst() | ApplInst() | AbstInst() | ConvInst():
+            return type(inst)(f(inst.lnum), f(inst.pre1), f(inst.pre2))
+        case _:
+            raise FormatError(f"cannot renumber: {inst}")
+
+
+def rename_vars(inst: Instruction, names: dict[str, str]) -> Instruction:
+    # var, weakの変数名をnamesで付け替えた命令（namesにない名前はそのまま）
+    match inst:
+        case VarInst(lnum, pre, var) if var.name in names:
+            return VarInst(lnum, pre, VarTerm(names[var.name]))
+        case WeakInst(lnum, pre1, pre2, var) if var in names:
+            return WeakInst(lnum, pre1, pre2, names[var])
+        case _:
+            return inst
+
+
+def last_uses(premise_lists: Iterable[list[int]]) -> dict[int, int]:
+    # 各判断を最後に参照する命令の位置（命令列での0からの位置）。
+    # premise_listsは命令ごとの参照する判断の番号。一度も参照されない判断は含まない
+    last: dict[int, int] = {}
+    for pos, pres in enumerate(premise_lists):
+        for i in pres:
+            last[i] = pos
+    return last
+
+
+def release_schedule(last: dict[int, int]) -> dict[int, list[int]]:
+    # 命令の位置から、その命令を検査したあとに捨ててよい判断の番号のリストへの写像
+    schedule: dict[int, list[int]] = {}
+    for i, pos in last.items():
+        schedule.setdefault(pos, []).append(i)
+    return schedule
+
+
+def scan_premises(inst_code: str) -> list[int]:
+    # 命令行が参照する判断の番号を、項を読まずに取り出す
+    tokens = inst_code.split(" ")
+    if len(tokens) < 3:
+        return []
+    match tokens[1]:
+        case "var" | "cp" | "sp":
+            return [int(tokens[2])]
+        case "weak" | "form" | "appl" | "abst" | "def" | "defpr" | "conv":
+            return [int(tokens[2]), int(tokens[3])]
+        case "inst":
+            return [int(tokens[2])] + list(map(int, tokens[4:-1]))
+        case _:
+            return []
+
+
+# 命令に現れる変数名。入力の変数名（英字1文字）のほか、deriveがつけるフレッシュな名前も読む
+var_name_re = re.compile(r"[a-zA-Z]|\^[0-9]+")
+
+
+def scan_var(lnum: int, inst_code: str, token: str) -> VarTerm:
+    if not var_name_re.fullmatch(token):
+        raise __fmtErr(lnum, inst_code, "not a variable")
+    # このプロセスで生成するフレッシュな名前が、読んだ^Nを捕獲しないようにする
+    Fresh.reserve(token)
+    return VarTerm(token)
+
+
 def scan_inst(inst_code: str) -> Instruction:
     tokens = inst_code.split(" ")
     if len(tokens) == 0:
@@ -133,19 +429,13 @@ def scan_inst(inst_code: str) -> Instruction:
         case "sort":
             return SortInst(lnum=lnum)
         case "var":
-            mb_var = parse_term(tokens[3])
-            if not isinstance(mb_var, VarTerm):
-                raise __fmtErr(lnum, inst_code, "not a variable")
-            else:
-                return VarInst(lnum=lnum, pre=int(tokens[2]), var=mb_var)
+            var = scan_var(lnum, inst_code, tokens[3])
+            return VarInst(lnum=lnum, pre=int(tokens[2]), var=var)
         case "weak":
-            mb_var = parse_term(tokens[4])
-            if not isinstance(mb_var, VarTerm):
-                raise __fmtErr(lnum, inst_code, "not a variable")
-            else:
-                return WeakInst(
-                    lnum=lnum, pre1=int(tokens[2]), pre2=int(tokens[3]), var=mb_var.name
-                )
+            var = scan_var(lnum, inst_code, tokens[4])
+            return WeakInst(
+                lnum=lnum, pre1=int(tokens[2]), pre2=int(tokens[3]), var=var.name
+            )
         case "form":
             return FormInst(lnum=lnum, pre1=int(tokens[2]), pre2=int(tokens[3]))
         case "appl":
@@ -0,0 +1,377 @@
+# nameless.py
+# 束縛変数をde Bruijn indexで、自由変数だけを名前で表す項（locally nameless）と、
+# その上の代入を定義する。
+# 束縛変数に名前がないので、代入のときに変数の捕獲を避けるための名前の付け替えが要らない。
+
+from dataclasses import dataclass
+from typing import Sequence
+
+from fresh_name import Fresh
+from parse import (
+    AppTerm,
+    ConstTerm,
+    LambdaTerm,
+    PiTerm,
+    SortTerm,
+    StarTerm,
+    Term,
+    UnExpectedTermError,
+    VarTerm,
+)
+
+
+@dataclass(frozen=True, slots=True)
+class NTerm:
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class NBound(NTerm):
+    # 束縛変数。indexは何個内側の束縛子で束縛されているか（0が一番内側）
+    index: int
+
+
+@dataclass(frozen=True, slots=True)
+class NFree(NTerm):
+    name: str
+
+
+@dataclass(frozen=True, slots=True)
+class NStar(NTerm):
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class NSort(NTerm):
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class NApp(NTerm):
+    t1: NTerm
+    t2: NTerm
+
+
+@dataclass(frozen=True, slots=True)
+class NLambda(NTerm):
+    # hintは元の束縛変数名。名前に戻すときに、衝突しなければそのまま使う
+    t1: NTerm
+    t2: NTerm
+    hint: str
+
+
+@dataclass(frozen=True, slots=True)
+class NPi(NTerm):
+    t1: NTerm
+    t2: NTerm
+    hint: str
+
+
+@dataclass(frozen=True, slots=True)
+class NConst(NTerm):
+    op: str
+    children: tuple[NTerm, ...]
+
+
+def to_nameless(t: Term) -> NTerm:
+    return to_nameless_with_env_depth(t, {}, 0)
+
+
+def to_nameless_with_env_depth(t: Term, env: dict[str, int], depth: int) -> NTerm:
+    # envは束縛変数名から、それを束縛した深さへの写像。束縛子の本体をたどるあいだだけ書き換え、
+    # 終われば元に戻す。深い項でも再帰しないように、subst.pyと同じく明示的なスタックで
+    # 帰りがけ順にたどる。スタックの各要素は（部分項, 段階, 深さ, 覆い隠した束縛の深さ）
+    done: list[NTerm] = []
+    stack: list[tuple[Term, int, int, int | None]] = [(t, 0, depth, None)]
+    while stack:
+        t, stage, depth, shadowed = stack.pop()
+        if isinstance(t, VarTerm):
+            d = env.get(t.name)
+            done.append(NFree(t.name) if d is None else NBound(depth - d - 1))
+        elif isinstance(t, StarTerm):
+            done.append(NStar())
+        elif isinstance(t, SortTerm):
+            done.append(NSort())
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            if stage == 0:
+                stack.append((t, 1, depth, None))
+                stack.append((t.t1, 0, depth, None))
+            elif stage == 1:
+                stack.append((t, 2, depth, env.get(t.name)))
+                env[t.name] = depth
+                stack.append((t.t2, 0, depth + 1, None))
+            else:
+                if shadowed is None:
+                    del env[t.name]
+                else:
+                    env[t.name] = shadowed
+                n2 = done.pop()
+                n1 = done.pop()
+                if isinstance(t, LambdaTerm):
+                    done.append(NLambda(n1, n2, t.name))
+                else:
+                    done.append(NPi(n1, n2, t.name))
+        elif isinstance(t, AppTerm):
+            if stage == 0:
+                stack.append((t, 1, depth, None))
+                stack.append((t.t2, 0, depth, None))
+                stack.append((t.t1, 0, depth, None))
+            else:
+                n2 = done.pop()
+                done.append(NApp(done.pop(), n2))
+        elif isinstance(t, ConstTerm):
+            if stage == 0:
+                stack.append((t, 1, depth, None))
+                stack += [(tt, 0, depth, None) for tt in reversed(t.children)]
+            else:
+                k = len(t.children)
+                children = tuple(done[len(done) - k :])
+                del done[len(done) - k :]
+                done.append(NConst(t.op, children))
+        else:
+            raise UnExpectedTermError(t)
+    return done[-1]
+
+
+def free_names(n: NTerm) -> set[str]:
+    names: set[str] = set()
+    stack = [n]
+    while stack:
+        n = stack.pop()
+        if isinstance(n, NFree):
+            names.add(n.name)
+        elif isinstance(n, NApp) or isinstance(n, NLambda) or isinstance(n, NPi):
+            stack.append(n.t1)
+            stack.append(n.t2)
+        elif isinstance(n, NConst):
+            stack.extend(n.children)
+    return names
+
+
+def from_nameless(n: NTerm) -> Term:
+    # 束縛変数にはhintの名前をつける。
+    # ただし、その名前で自由変数や外側の束縛変数を捕獲してしまうときはフレッシュな名前をつける
+    return from_nameless_with_scope(n, [], free_names(n))
+
+
+def from_nameless_with_scope(n: NTerm, scope: list[str], avoid: set[str]) -> Term:
+    # scopeは外側から順に並べた束縛変数名。avoidは自由変数名とscopeの和集合で、
+    # hintがavoidに入っているときだけ実際に捕獲が起きるかを調べる。
+    # 明示的なスタックで帰りがけ順にたどる。スタックの各要素は
+    # （部分項, 段階, 束縛変数につけた名前, その名前がもとからavoidに入っていたか）
+    done: list[Term] = []
+    stack: list[tuple[NTerm, int, str, bool]] = [(n, 0, "", False)]
+    while stack:
+        n, stage, name, shadowed = stack.pop()
+        if isinstance(n, NBound):
+            done.append(VarTerm(scope[-1 - n.index]))
+        elif isinstance(n, NFree):
+            done.append(VarTerm(n.name))
+        elif isinstance(n, NStar):
+            done.append(StarTerm())
+        elif isinstance(n, NSort):
+            done.append(SortTerm())
+        elif isinstance(n, NLambda) or isinstance(n, NPi):
+            if stage == 0:
+                stack.append((n, 1, "", False))
+                stack.append((n.t1, 0, "", False))
+            elif stage == 1:
+                name = n.hint
+                if name in avoid and captures(n.t2, name, scope):
+                    name = Fresh.fresh()
+                stack.append((n, 2, name, name in avoid))
+                scope.append(name)
+                avoid.add(name)
+                stack.append((n.t2, 0, "", False))
+            else:
+                scope.pop()
+                if not shadowed:
+                    avoid.discard(name)
+                t2 = done.pop()
+                t1 = done.pop()
+                if isinstance(n, NLambda):
+                    done.append(LambdaTerm(t1, t2, name))
+                else:
+                    done.append(PiTerm(t1, t2, name))
+        elif isinstance(n, NApp):
+            if stage == 0:
+                stack.append((n, 1, "", False))
+                stack.append((n.t2, 0, "", False))
+                stack.append((n.t1, 0, "", False))
+            else:
+                t2 = done.pop()
+                done.append(AppTerm(done.pop(), t2))
+        elif isinstance(n, NConst):
+            if stage == 0:
+                stack.append((n, 1, "", False))
+                stack += [(nn, 0, "", False) for nn in reversed(n.children)]
+            else:
+                k = len(n.children)
+                children = done[len(done) - k :]
+                del done[len(done) - k :]
+                done.append(ConstTerm(n.op, children))
+        else:
+            raise UnExpectedTermError(n)
+    return done[-1]
+
+
+def captures(body: NTerm, name: str, scope: list[str]) -> bool:
+    # 束縛子の本体bodyで、その束縛変数をnameと名付けると
+    # 自由変数か外側の束縛変数を捕獲してしまうかどうか
+    stack = [(body, 0)]
+    while stack:
+        n, k = stack.pop()
+        if isinstance(n, NFree):
+            if n.name == name:
+                return True
+        elif isinstance(n, NBound):
+            if n.index > k and scope[-1 - (n.index - k - 1)] == name:
+                return True
+        elif isinstance(n, NApp):
+            stack.append((n.t1, k))
+            stack.append((n.t2, k))
+        elif isinstance(n, NLambda) or isinstance(n, NPi):
+            stack.append((n.t1, k))
+            stack.append((n.t2, k + 1))
+        elif isinstance(n, NConst):
+            stack.extend((nn, k) for nn in n.children)
+    return False
+
+
+def rebuild(n: NTerm, done: list[NTerm]) -> NTerm:
+    # doneの末尾から作り終えた部分項を取り出して、n（適用、束縛子、定数）と同じ形の項を組み立てる。
+    # 部分項がどれも変わっていなければn自身を返す
+    if isinstance(n, NConst):
+        k = len(n.children)
+        parts = done[len(done) - k :]
+        del done[len(done) - k :]
+        if all(p is q for p, q in zip(parts, n.children)):
+            return n
+        return NConst(n.op, tuple(parts))
+    elif isinstance(n, NApp) or isinstance(n, NLambda) or isinstance(n, NPi):
+        t2 = done.pop()
+        t1 = done.pop()
+        if t1 is n.t1 and t2 is n.t2:
+            return n
+        if isinstance(n, NApp):
+            return NApp(t1, t2)
+        return type(n)(t1, t2, n.hint)
+    raise UnExpectedTermError(n)
+
+
+def replace_free(n: NTerm, mapping: dict[str, NTerm]) -> NTerm:
+    # 自由変数を同時に置き換える。置き換える項は局所的に閉じている（NBoundがはみ出さない）ので、
+    # 束縛子をくぐってもindexをずらす必要がない。
+    # 変化のなかった部分項は元のオブジェクトをそのまま返す。
+    # 明示的なスタックで帰りがけ順にたどる。スタックの各要素は（部分項, 部分項を作り終えたか）
+    done: list[NTerm] = []
+    stack: list[tuple[NTerm, bool]] = [(n, False)]
+    while stack:
+        n, built = stack.pop()
+        if built:
+            done.append(rebuild(n, done))
+        elif isinstance(n, NFree):
+            done.append(mapping.get(n.name, n))
+        elif isinstance(n, NApp) or isinstance(n, NLambda) or isinstance(n, NPi):
+            stack.append((n, True))
+            stack.append((n.t2, False))
+            stack.append((n.t1, False))
+        elif isinstance(n, NConst):
+            stack.append((n, True))
+            stack += [(nn, False) for nn in reversed(n.children)]
+        else:
+            done.append(n)
+    return done[-1]
+
+
+def instantiate(n: NTerm, value: NTerm, index: int = 0) -> NTerm:
+    # 束縛子の本体nについて、その束縛子が束縛する変数（NBound(index)）をvalueで置き換える。
+    # valueは局所的に閉じているのでずらす必要はない。
+    # 明示的なスタックで帰りがけ順にたどる。スタックの各要素は（部分項, index, 作り終えたか）
+    done: list[NTerm] = []
+    stack: list[tuple[NTerm, int, bool]] = [(n, index, False)]
+    while stack:
+        n, index, built = stack.pop()
+        if built:
+            done.append(rebuild(n, done))
+        elif isinstance(n, NBound):
+            if n.index == index:
+                done.append(value)
+            elif n.index > index:
+                done.append(NBound(n.index - 1))
+            else:
+                done.append(n)
+        elif isinstance(n, NApp):
+            stack.append((n, index, True))
+            stack.append((n.t2, index, False))
+            stack.append((n.t1, index, False))
+        elif isinstance(n, NLambda) or isinstance(n, NPi):
+            stack.append((n, index, True))
+            stack.append((n.t2, index + 1, False))
+            stack.append((n.t1, index, False))
+        elif isinstance(n, NConst):
+            stack.append((n, index, True))
+            stack += [(nn, index, False) for nn in reversed(n.children)]
+        else:
+            done.append(n)
+    return done[-1]
+
+
+def abstract(t: Term, names: Sequence[str]) -> NTerm:
+    # namesを外側からこの順に並んだ束縛子で束縛されているとみなしてnamelessにする。
+    # 本体の外にk個の束縛子があるので、深さdでのnames[j]はNBound(d + k - j - 1)になる
+    k = len(names)
+    return to_nameless_with_env_depth(t, {name: j for j, name in enumerate(names)}, k)
+
+
+def instantiate_all(n: NTerm, values: list[NTerm], depth: int = 0) -> NTerm:
+    # abstractで作ったテンプレートnの、外側のk個の束縛変数をvaluesで同時に置き換える。
+    # 一度の走査で済む。valuesは局所的に閉じているのでずらす必要はない。
+    # 変化のなかった部分項は元のオブジェクトをそのまま返す。
+    # instantiateと同じく明示的なスタックでたどる。スタックの各要素は（部分項, 深さ, 作り終えたか）
+    done: list[NTerm] = []
+    stack: list[tuple[NTerm, int, bool]] = [(n, depth, False)]
+    while stack:
+        n, depth, built = stack.pop()
+        if built:
+            done.append(rebuild(n, done))
+        elif isinstance(n, NBound):
+            if n.index < depth:
+                done.append(n)
+            else:
+                done.append(values[len(values) - 1 - (n.index - depth)])
+        elif isinstance(n, NApp):
+            stack.append((n, depth, True))
+            stack.append((n.t2, depth, False))
+            stack.append((n.t1, depth, False))
+        elif isinstance(n, NLambda) or isinstance(n, NPi):
+            stack.append((n, depth, True))
+            stack.append((n.t2, depth + 1, False))
+            stack.append((n.t1, depth, False))
+        elif isinstance(n, NConst):
+            stack.append((n, depth, True))
+            stack += [(nn, depth, False) for nn in reversed(n.children)]
+        else:
+            done.append(n)
+    return done[-1]
+
+
+def subst(t1: Term, t2: Term, name: str) -> Term:
+    # t1[name !--> t2]
+    return subst_all(t1, [name], [t2])
+
+
+def subst_all(t: Term, names: list[str], terms: list[Term]) -> Term:
+    mapping = {name: to_nameless(u) for name, u in zip(names, terms)}
+    n = to_nameless(t)
+    replaced = replace_free(n, mapping)
+    if replaced is n:
+        return t
+    return from_nameless(replaced)
+
+
+def beta_reduction(f: LambdaTerm, t: Term) -> Term:
+    n = to_nameless(f)
+    if not isinstance(n, NLambda):
+        raise UnExpectedTermError(f)
+    return from_nameless(instantiate(n.t2, to_nameless(t)))
@@ -0,0 +1,229 @@
+# nbe.py
+# Normalization by Evaluation によるβ・δ正規化
+#
+# 項を意味領域の値（Value）に評価してから、値を項に読み戻す（readback）ことで正規形を得る。
+# 束縛子の本体は環境とともに閉包（Closure）として持ち、適用されたときに初めて評価するので、
+# β簡約やδ簡約のたびに項を代入して作り直すことがない。
+# 読み戻しはnameless.pyの表現を経由し、束縛変数名はnameless.from_namelessがつける。
+# 深い項でも再帰しないように、評価も読み戻しも明示的なスタックで行う。
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from nameless import (
+    NApp,
+    NBound,
+    NConst,
+    NFree,
+    NLambda,
+    NPi,
+    NSort,
+    NStar,
+    NTerm,
+    from_nameless,
+)
+from parse import (
+    AppTerm,
+    ConstTerm,
+    LambdaTerm,
+    PiTerm,
+    SortTerm,
+    StarTerm,
+    Term,
+    UnExpectedTermError,
+    VarTerm,
+)
+
+if TYPE_CHECKING:
+    from check import Environment
+
+
+class Value:
+    __slots__ = ()
+
+
+@dataclass(frozen=True, slots=True)
+class Closure:
+    # 束縛子の本体bodyと、それを評価するときの環境
+    env: dict[str, Value]
+    body: Term
+    name: str
+
+
+@dataclass(frozen=True, slots=True)
+class VStar(Value):
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class VSort(Value):
+    pass
+
+
+@dataclass(frozen=True, slots=True)
+class VLambda(Value):
+    tp: Value
+    closure: Closure
+
+
+@dataclass(frozen=True, slots=True)
+class VPi(Value):
+    tp: Value
+    closure: Closure
+
+
+@dataclass(frozen=True, slots=True)
+class VFree(Value):
+    # 文脈の変数など、評価の外で束縛されている変数
+    name: str
+
+
+@dataclass(frozen=True, slots=True)
+class VLevel(Value):
+    # 読み戻しのときに束縛子の下に入るために作る変数。levelは外側から数えた深さ
+    level: int
+
+
+@dataclass(frozen=True, slots=True)
+class VApp(Value):
+    # 頭が変数で、それ以上簡約できない適用
+    v1: Value
+    v2: Value
+
+
+@dataclass(frozen=True, slots=True)
+class VConst(Value):
+    # 本体を持たない定数（def-prim）の適用
+    op: str
+    children: tuple[Value, ...]
+
+
+class NbEError(Exception):
+    pass
+
+
+def normalize(t: Term, env: "Environment") -> Term:
+    return from_nameless(readback(evaluate(t, {}, env), 0, env))
+
+
+def evaluate(t: Term, scope: dict[str, Value], env: "Environment") -> Value:
+    # scopeは変数名から値への写像、envは定義の列。
+    # 深い項でも再帰しないように、明示的なスタックで帰りがけ順にたどる。
+    # スタックの各要素は（部分項, そのscope, 部分項を評価し終えたか）。
+    # β簡約とδ簡約は、簡約した先の評価をスタックに積むだけで、その値がそのまま結果になる
+    done: list[Value] = []
+    stack: list[tuple[Term, dict[str, Value], bool]] = [(t, scope, False)]
+    while stack:
+        t, scope, built = stack.pop()
+        if isinstance(t, VarTerm):
+            v = scope.get(t.name)
+            done.append(VFree(t.name) if v is None else v)
+        elif isinstance(t, StarTerm):
+            done.append(VStar())
+        elif isinstance(t, SortTerm):
+            done.append(VSort())
+        elif isinstance(t, AppTerm):
+            if not built:
+                stack.append((t, scope, True))
+                stack.append((t.t2, scope, False))
+                stack.append((t.t1, scope, False))
+                continue
+            v = done.pop()
+            f = done.pop()
+            if isinstance(f, VLambda):
+                stack.append((f.closure.body, bind(f.closure, v), False))
+            else:
+                done.append(VApp(f, v))
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            if not built:
+                stack.append((t, scope, True))
+                stack.append((t.t1, scope, False))
+            elif isinstance(t, LambdaTerm):
+                done.append(VLambda(done.pop(), Closure(scope, t.t2, t.name)))
+            else:
+                done.append(VPi(done.pop(), Closure(scope, t.t2, t.name)))
+        elif isinstance(t, ConstTerm):
+            if not built:
+                stack.append((t, scope, True))
+                stack += [(tt, scope, False) for tt in reversed(t.children)]
+                continue
+            k = len(t.children)
+            children = done[len(done) - k :]
+            del done[len(done) - k :]
+            # check.lookup_definitionと同じく、環境の名前からの索引を引く
+            found = env.lookup(t.op)
+            if found is None:
+                raise NbEError(f"{t}:\n  definition not found")
+            dfn = found[1]
+            names = dfn.context.params()
+            if len(names) != len(children):
+                raise NbEError(f"{t}:\n  arity mismatch")
+            if dfn.is_prim:
+                done.append(VConst(t.op, tuple(children)))
+            else:
+                # δ簡約: 定義の本体を、パラメタを引数に束縛した環境で評価する
+                stack.append((dfn.body, dict(zip(names, children)), False))
+        else:
+            raise UnExpectedTermError(t)
+    return done[-1]
+
+
+def bind(c: Closure, v: Value) -> dict[str, Value]:
+    # 閉包の環境に、束縛変数の値vを足したもの
+    scope = c.env.copy()
+    scope[c.name] = v
+    return scope
+
+
+def instantiate(c: Closure, v: Value, env: "Environment") -> Value:
+    return evaluate(c.body, bind(c, v), env)
+
+
+def readback(v: Value, level: int, env: "Environment") -> NTerm:
+    # levelは今いる束縛子の深さ。VLevelはde Bruijn indexに直す。
+    # evaluateと同じく明示的なスタックでたどる。束縛子の本体は、閉包をVLevelで評価してから積む
+    done: list[NTerm] = []
+    stack: list[tuple[Value, int, bool]] = [(v, level, False)]
+    while stack:
+        v, level, built = stack.pop()
+        if isinstance(v, VLevel):
+            done.append(NBound(level - v.level - 1))
+        elif isinstance(v, VFree):
+            done.append(NFree(v.name))
+        elif isinstance(v, VStar):
+            done.append(NStar())
+        elif isinstance(v, VSort):
+            done.append(NSort())
+        elif isinstance(v, VApp):
+            if not built:
+                stack.append((v, level, True))
+                stack.append((v.v2, level, False))
+                stack.append((v.v1, level, False))
+            else:
+                n2 = done.pop()
+                done.append(NApp(done.pop(), n2))
+        elif isinstance(v, VLambda) or isinstance(v, VPi):
+            if not built:
+                stack.append((v, level, True))
+                body = instantiate(v.closure, VLevel(level), env)
+                stack.append((body, level + 1, False))
+                stack.append((v.tp, level, False))
+            else:
+                body = done.pop()
+                tp = done.pop()
+                if isinstance(v, VLambda):
+                    done.append(NLambda(tp, body, v.closure.name))
+                else:
+                    done.append(NPi(tp, body, v.closure.name))
+        elif isinstance(v, VConst):
+            if not built:
+                stack.append((v, level, True))
+                stack += [(vv, level, False) for vv in reversed(v.children)]
+            else:
+                k = len(v.children)
+                children = tuple(done[len(done) - k :])
+                del done[len(done) - k :]
+                done.append(NConst(v.op, children))
+        else:
+            raise NbEError(f"unexpected value: {v}")
+    return done[-1]
@@ -3,20 +3,101 @@
 
 import argparse
 import re
-from dataclasses import dataclass
-from typing import Tuple
+import weakref
+from dataclasses import dataclass, field, fields
+from typing import Any
 
 
-@dataclass(frozen=True)
-class Term:
+class Shape:
+    # 項から束縛変数の名前を忘れた形（de Bruijn表現）。
+    # 同じ形は同じShapeオブジェクトになるようにinternするので、
+    # α同値かどうかはShapeの同一性で判定できる。
+    __slots__ = ("key", "__weakref__")
+
+    def __init__(self, key: tuple[Any, ...]):
+        self.key = key
+
+
+_shapes: "weakref.WeakValueDictionary[tuple[Any, ...], Shape]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+def intern_shape(key: tuple[Any, ...]) -> Shape:
+    # keyの中の部分形はShapeオブジェクト（idでハッシュされる）なので、ハッシュは定数時間
+    s = _shapes.get(key)
+    if s is None:
+        s = Shape(key)
+        _shapes[key] = s
+    return s
+
+
+_terms: "weakref.WeakValueDictionary[tuple[Any, ...], Term]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+def _intern_key(arg: Any) -> Any:
+    # 部分項はinternされているので、同一性（id）で区別すれば十分。
+    # 項が生きている間は部分項も生きているので、idが使い回されることはない
+    if isinstance(arg, Term):
+        return id(arg)
+    if isinstance(arg, tuple):
+        return tuple(map(id, arg))
+    return arg
+
+
+class TermFactory(type):
+    """
+    項のハッシュコンシング。
+    同じクラス・同じ名前・同一の部分項から作られる項は、既存のオブジェクトを返す。
+    これにより、構造が同じ項（束縛変数名も含めて同じもの）は常に同じオブジェクトになる。
+    表は弱参照で持つので、使われなくなった項は回収される。
+    """
+
+    def __call__(cls, *args: Any, **kwargs: Any) -> Any:
+        if kwargs:
+            names = [f.name for f in fields(cls) if f.init]
+            args = args + tuple(kwargs[n] for n in names[len(args) :])
+        args = tuple(tuple(a) if isinstance(a, list) else a for a in args)
+        key = (cls, *map(_intern_key, args))
+        t = _terms.get(key)
+        if t is None:
+            t = super().__call__(*args)
+            _terms[key] = t
+        return t
+
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
+class Term(metaclass=TermFactory):
+    # 構造が同じ項は同じオブジェクトなので、==（α同値）はまず同一性で判定できる。
+    # ハッシュはα同値な項で一致するように、Shapeから計算する
+    _shape: Shape | None = field(default=None, init=False, repr=False, compare=False)
+
     def __eq__(self, that):
         return alpha_eqv(self, that)
 
     def __ne__(self, that):
         return not alpha_eqv(self, that)
 
+    def __hash__(self) -> int:
+        return id(self.shape)
+
+    def __reduce__(self):
+        # 復元もTermFactoryを通して、プロセスをまたいでもinternされるようにする
+        args = tuple(getattr(self, f.name) for f in fields(self) if f.init)
+        return (type(self), args)
+
+    @property
+    def shape(self) -> Shape:
+        s = self._shape
+        if s is None:
+            s = shape_with_env_depth(self, {}, 0)
+            object.__setattr__(self, "_shape", s)
+        return s
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, eq=False, slots=True)
 class VarTerm(Term):
     name: str
 
@@ -24,54 +105,79 @@ class VarTerm(Term):
         return self.name
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False, slots=True)
 class StarTerm(Term):
     def __str__(self) -> str:
         return "*"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False, slots=True)
 class SortTerm(Term):
     def __str__(self) -> str:
         return "@"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False, slots=True)
 class AppTerm(Term):
     t1: Term
     t2: Term
 
     def __str__(self) -> str:
-        return f"%({self.t1})({self.t2})"
+        return show(self)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False, slots=True)
 class LambdaTerm(Term):
     t1: Term
     t2: Term
     name: str
 
     def __str__(self) -> str:
-        return f"${self.name}:({self.t1}).({self.t2})"
+        return show(self)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False, slots=True)
 class PiTerm(Term):
     t1: Term
     t2: Term
     name: str
 
     def __str__(self) -> str:
-        return f"?{self.name}:({self.t1}).({self.t2})"
+        return show(self)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False, slots=True)
 class ConstTerm(Term):
     op: str
-    children: list[Term]
+    children: tuple[Term, ...]
 
     def __str__(self) -> str:
-        return f"{self.op}[{','.join(map(lambda t: f'({t})', self.children))}]"
+        return show(self)
+
+
+def show(t: Term) -> str:
+    # 項の文字列表現。深い項でも再帰しないように、書き出す断片を明示的なスタックに積む。
+    # スタックには文字列（そのまま書く）と項（展開してから書く）を、書く順の逆に積む
+    out: list[str] = []
+    stack: list[Term | str] = [t]
+    while stack:
+        t = stack.pop()
+        if isinstance(t, str):
+            out.append(t)
+        elif isinstance(t, AppTerm):
+            stack += [")", t.t2, ")(", t.t1]
+            out.append("%(")
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            stack += [")", t.t2, ").(", t.t1]
+            out.append(f"{'$' if isinstance(t, LambdaTerm) else '?'}{t.name}:(")
+        elif isinstance(t, ConstTerm):
+            out.append(f"{t.op}[")
+            stack.append("]")
+            for i in reversed(range(len(t.children))):
+                stack += [")", t.children[i], "(" if i == 0 else ",("]
+        else:
+            out.append(str(t))
+    return "".join(out)
 
 
 class SyntaxError(Exception):
@@ -82,193 +188,327 @@ class UnExpectedTermError(Exception):
     pass
 
 
-def parse_term(code: str) -> Term:
-    # 失敗したらSyntaxErrorを投げる
-    if is_var(code):
-        return VarTerm(name=code)
-    if is_star(code):
-        return StarTerm()
-    if is_sort(code):
-        return SortTerm()
-    if is_app(code):
-        code1, end = find_first_term(code)
-        code2, _ = find_first_term(code[end:])
-        t1 = parse_term(code1)
-        t2 = parse_term(code2)
-        return AppTerm(t1, t2)
-    if is_lambda(code):
-        var = code[1]
-        code1, end = find_first_term(code)
-        if not code[end] == ".":
-            raise SyntaxError(
-                f"parsing lambda in {code}\nexpect: '.', found: {code[end]}\n"
-            )
-        code2, _ = find_first_term(code[end:])
-        t1 = parse_term(code1)
-        t2 = parse_term(code2)
-        return LambdaTerm(t1, t2, var)
-    if is_type(code):
-        var = code[1]
-        code1, end = find_first_term(code)
-        if not code[end] == ".":
-            raise SyntaxError(
-                f"parsing type in {code}\nexpect: '.', found: {code[end]}\n"
-            )
-        code2, _ = find_first_term(code[end:])
-        t1 = parse_term(code1)
-        t2 = parse_term(code2)
-        return PiTerm(t1, t2, var)
-    if is_const(code):
-        op_name, fresh_code = divide_const(code)
-        # fresh_code = code
-        code_list: list[str] = []
-        while True:
-            code1, next_start = find_first_term(fresh_code)
-            if next_start == 0:
-                if not fresh_code[next_start] in ["[", "]"]:
-                    raise SyntaxError(
-                        f"`{fresh_code}` {next_start} {fresh_code[next_start]}"
-                    )
-                break
-            if not fresh_code[next_start] in [",", "]"]:
-                raise SyntaxError(
-                    f"`{fresh_code}` {next_start} {fresh_code[next_start]}"
-                )
-            code_list.append(code1)
-            fresh_code = fresh_code[next_start:]
-        term_list = list(map(lambda code: parse_term(code), code_list))
-        return ConstTerm(op_name, term_list)
-    raise SyntaxError(f"マッチする式がない: {code}")
-
-
-op_name_re = re.compile("([a-zA-Z0-9][a-zA-Z0-9_]+)\\[")
-
-
-def divide_const(code: str) -> Tuple[str, str]:
-    i = code.find("[")
-    return code[:i], code[i:]
-
-
-def find_first_term(code: str) -> Tuple[str, int]:
-    # 初めのかっこで正しく囲まれたコードを返す。
-    # かっこの終わった次のインデックスも同時に返す
-    # 該当する式がない場合、第二返り値を0とする
-    # e.g. %((M))(N)  --> (M), 5
-    # idx: 012345
-    count = 0
-    start = -1
-    end = -1
-    for i in range(len(code)):
-        if code[i] == "(":
-            count += 1
-            if start == -1:
-                start = i
-
-        if code[i] == ")":
-            count -= 1
-            if count == 0:
-                end = i
-                break
-    return code[start + 1 : end], end + 1
-
+# 構文
+#   M ::= x | * | @ | %(M)(M) | $x:(M).(M) | ?x:(M).(M) | c[(M),...,(M)]
+# xは英字1文字、cは英字から始まる英数字・`_`・`.`の列
 
+name_re = re.compile("[a-zA-Z][a-zA-Z0-9_.]*")  # 先生から頂いた例を受け入れるために`.`を許した
 var_re = re.compile("^[a-zA-Z]$")
 
+# 構文解析中の、部分項を待っている構築途中の項の種類
+_APP = 0
+_LAMBDA = 1
+_PI = 2
+_CONST = 3
+_WHAT = {_APP: "app", _LAMBDA: "lambda", _PI: "type", _CONST: "const"}
 
-def is_var(code: str):
-    return var_re.match(code)
 
+def fmtSyntaxError(code: str, pos: int, msg: str) -> SyntaxError:
+    return SyntaxError(f"{msg} (at {pos})\n{code}\n{' ' * pos}^")
 
-def is_star(code: str):
-    return code == "*"
-
-
-def is_sort(code: str):
-    return code == "@"
-
-
-def is_app(code: str):
-    return code[0] == "%"
-
-
-def is_lambda(code: str):
-    return code[0] == "$"
 
+def parse_term(code: str) -> Term:
+    # 失敗したらSyntaxErrorを投げる
+    # 先頭から一度だけ読み進める。入れ子は明示的なスタックで管理するので、深い項でも再帰しない。
+    # スタックの各要素は（種類, 読み終えた部分項のリスト, 束縛変数名または定数名）
+    code = code.rstrip()
+    n = len(code)
+    pos = 0
+    stack: list[tuple[int, list[Term], str]] = []
+
+    def expect(c: str, what: str):
+        nonlocal pos
+        found = code[pos] if pos < n else "EOF"
+        if found != c:
+            msg = f"parsing {what}\nexpect: '{c}', found: {found}"
+            raise fmtSyntaxError(code, pos, msg)
+        pos += 1
+
+    while True:
+        # 項の先頭を読む。部分項を持つ項ならスタックに積んで、最初の部分項を読みに行く
+        c = code[pos] if pos < n else ""
+        if c == "*":
+            pos += 1
+            term: Term = StarTerm()
+        elif c == "@":
+            pos += 1
+            term = SortTerm()
+        elif c == "%":
+            pos += 1
+            expect("(", _WHAT[_APP])
+            stack.append((_APP, [], ""))
+            continue
+        elif c == "$" or c == "?":
+            kind = _LAMBDA if c == "$" else _PI
+            pos += 1
+            var = code[pos] if pos < n else ""
+            if not var_re.match(var):
+                raise fmtSyntaxError(
+                    code, pos, f"parsing {_WHAT[kind]}\nexpect: variable, found: {var}"
+                )
+            pos += 1
+            expect(":", _WHAT[kind])
+            expect("(", _WHAT[kind])
+            stack.append((kind, [], var))
+            continue
+        else:
+            mo = name_re.match(code, pos)
+            if not mo:
+                raise fmtSyntaxError(code, pos, f"マッチする式がない: {code[pos:]}")
+            name = mo.group(0)
+            pos = mo.end()
+            if pos < n and code[pos] == "[":
+                pos += 1
+                if pos < n and code[pos] == "]":
+                    pos += 1
+                    term = ConstTerm(name, ())
+                else:
+                    expect("(", _WHAT[_CONST])
+                    stack.append((_CONST, [], name))
+                    continue
+            elif var_re.match(name):
+                term = VarTerm(name)
+            else:
+                raise fmtSyntaxError(code, mo.start(), f"マッチする式がない: {name}")
+
+        # 項を一つ読み終えた。構築途中の項に渡し、完成したらさらに外側へ渡す
+        while stack:
+            kind, children, name = stack[-1]
+            what = _WHAT[kind]
+            expect(")", what)
+            children.append(term)
+            if kind == _CONST:
+                found = code[pos] if pos < n else "EOF"
+                if found == ",":
+                    pos += 1
+                    expect("(", what)
+                    break
+                if found != "]":
+                    msg = f"parsing {what}\nexpect: ',' or ']', found: {found}"
+                    raise fmtSyntaxError(code, pos, msg)
+                pos += 1
+                term = ConstTerm(name, children)
+            elif len(children) == 1:
+                if kind != _APP:
+                    expect(".", what)
+                expect("(", what)
+                break
+            elif kind == _APP:
+                term = AppTerm(children[0], children[1])
+            elif kind == _LAMBDA:
+                term = LambdaTerm(children[0], children[1], name)
+            else:
+                term = PiTerm(children[0], children[1], name)
+            stack.pop()
+        else:
+            if pos != n:
+                raise fmtSyntaxError(code, pos, f"余分な文字列がある: {code[pos:]}")
+            return term
 
-def is_type(code: str):
-    return code[0] == "?"
 
+def alpha_eqv(t1: Term, t2: Term) -> bool:
+    # 同じ構造の項は同じオブジェクトなので、まずは同一性で判定する。
+    # 両方のShapeが計算済みならその同一性で判定し、そうでなければ構造をたどる
+    if t1 is t2:
+        return True
+    s1 = t1._shape
+    s2 = t2._shape
+    if s1 is not None and s2 is not None:
+        return s1 is s2
+    return alpha_with_env_depth(t1, t2, {}, {}, 0)
 
-op_name_re = re.compile("^[a-zA-Z][a-zA-Z0-9_.]*$")  # 先生から頂いた例を受け入れるために`.`を許した
 
+def shape_with_env_depth(t: Term, env: dict[str, int], depth: int) -> Shape:
+    # alpha_with_env_depthと同様に、束縛変数は束縛した深さ（env）で表す。
+    # Shapeには束縛からの距離（de Bruijn index）を載せる。
+    # 深い項でも再帰しないように、明示的なスタックで帰りがけ順にたどる。
+    # スタックの各要素は（部分項, その深さ, 部分形を作り終えたか）で、
+    # 作り終えた部分形はshapesに積む。束縛子の本体に入るときにenvを書き換え、出るときに戻す
+    shapes: list[Shape] = []
+    stack: "list[tuple[Term | _Bind, int, bool]]" = [(t, depth, False)]
+    restore: list[tuple[str, int | None]] = []
+    while stack:
+        t, depth, built = stack.pop()
+        if isinstance(t, VarTerm):
+            d = env.get(t.name)
+            if d is None:
+                shapes.append(intern_shape(("v", t.name)))
+            else:
+                shapes.append(intern_shape(("i", depth - d - 1)))
+        elif isinstance(t, StarTerm):
+            shapes.append(intern_shape(("*",)))
+        elif isinstance(t, SortTerm):
+            shapes.append(intern_shape(("@",)))
+        elif isinstance(t, AppTerm):
+            if built:
+                s2 = shapes.pop()
+                s1 = shapes.pop()
+                shapes.append(intern_shape(("%", s1, s2)))
+            else:
+                stack += [(t, depth, True), (t.t2, depth, False), (t.t1, depth, False)]
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            if built:
+                # 本体を作り終えた
+                name, shadowed = restore.pop()
+                if shadowed is None:
+                    del env[name]
+                else:
+                    env[name] = shadowed
+                s2 = shapes.pop()
+                s1 = shapes.pop()
+                tag = "$" if isinstance(t, LambdaTerm) else "?"
+                shapes.append(intern_shape((tag, s1, s2)))
+            else:
+                # 型を作ってから束縛する（_Bindが本体に入る前にenvを書き換える）
+                stack += [(t, depth, True), (t.t2, depth + 1, False)]
+                stack.append((_Bind(t.name, depth), depth, False))
+                stack.append((t.t1, depth, False))
+        elif isinstance(t, _Bind):
+            restore.append((t.name, env.get(t.name)))
+            env[t.name] = t.depth
+        elif isinstance(t, ConstTerm):
+            if built:
+                k = len(t.children)
+                children = shapes[len(shapes) - k :]
+                del shapes[len(shapes) - k :]
+                shapes.append(intern_shape(("c", t.op, *children)))
+            else:
+                stack.append((t, depth, True))
+                stack += [(tt, depth, False) for tt in reversed(t.children)]
+        else:
+            raise AlphaEqvException(
+                f"Error at shape_with_env_depth: unexpected term: {t}"
+            )
+    return shapes[-1]
 
-def is_const(code: str):
-    op_name = code.split("[")[0]
-    return op_name_re.match(op_name)
 
+class _Bind:
+    # shape_with_env_depthのスタックに積む、束縛子の本体に入るときの印
+    __slots__ = ("name", "depth")
 
-def alpha_eqv(t1: Term, t2: Term) -> bool:
-    return alpha_with_env_depth(t1, t2, {}, {}, 0)
+    def __init__(self, name: str, depth: int):
+        self.name = name
+        self.depth = depth
 
 
 class AlphaEqvException(Exception):
     pass
 
 
+# alpha_with_env_depthのスタックの要素の種類
+_COMPARE = 0  # 部分項の組を比べる
+_ENTER = 1  # 束縛子の本体に入る（環境に束縛を足す）
+_LEAVE = 2  # 束縛子の本体から出る（環境を戻す）
+
+
 def alpha_with_env_depth(
     t1: Term, t2: Term, env1: dict[str, int], env2: dict[str, int], depth: int
 ) -> bool:
     # 代入をしないで、環境をもつことにした。
     # 代入後の部分は、それ以降代入されることのない変数なのでこの手法でうまくいく。
-    # 環境は辞書で表現する。Shadowingは単に環境を上書きすれば良い。
-    # レキシカルスコープのために環境を書き換えるときにコピーが必要。
     # [x:=depth]を環境でもつ。ASTの構造が同じならば、変数を束縛した「深さ」がどこかだけを問題にすればよい。
-    if type(t1) != type(t2):
-        return False
-
-    if isinstance(t1, VarTerm) and isinstance(t2, VarTerm):
-        depth1 = env1.get(t1.name)
-        depth2 = env2.get(t2.name)
-        match (depth1, depth2):
-            case (None, None):
-                # 自由変数同士は名前で比較
-                return t1.name == t2.name
-            case (None, _):
-                return False
-            case (_, None):
-                return False
-            case (d1, d2):
-                # 束縛変数同士はde Bruijnで比較
-                return d1 == d2
-    elif (isinstance(t1, LambdaTerm) and isinstance(t2, LambdaTerm)) or (
-        isinstance(t1, PiTerm) and isinstance(t2, PiTerm)
-    ):
-        # $x:(M).(N)のMを検査
-        if not alpha_with_env_depth(t1.t1, t2.t1, env1, env2, depth):
-            return False
-        envc1 = env1.copy()
-        envc2 = env2.copy()
-        envc1[t1.name] = depth
-        envc2[t2.name] = depth
-        return alpha_with_env_depth(t1.t2, t2.t2, envc1, envc2, depth + 1)
-    elif (isinstance(t1, StarTerm) and isinstance(t2, StarTerm)) or (
-        isinstance(t1, SortTerm) and isinstance(t2, SortTerm)
-    ):
-        return True
-    elif isinstance(t1, AppTerm) and isinstance(t2, AppTerm):
-        return alpha_with_env_depth(
-            t1.t1, t2.t1, env1, env2, depth
-        ) and alpha_with_env_depth(t1.t2, t2.t2, env1, env2, depth)
-
-    elif isinstance(t1, ConstTerm) and isinstance(t2, ConstTerm):
-        if t1.op != t2.op:
-            return False
-        for (tt1, tt2) in zip(t1.children, t2.children):
-            if not alpha_with_env_depth(tt1, tt2, env1, env2, depth):
+    # 深い項でも再帰しないように、比べる部分項の組を明示的なスタックに積む。
+    # 環境は束縛子ごとにコピーせず、env1とenv2をその場で書き換える。
+    # 本体に入るときに上書きした束縛をundo_logに積み、出るときに戻す（Shadowingも戻せる）。
+    # 途中でFalseを返すときも含めて、呼び出し側のenv1とenv2は元に戻して返す。
+    # differは二つの環境で束縛が異なる名前の数で、0なら同じ部分項（同一のオブジェクト）は
+    # 中を見なくてもα同値とわかる
+    differ = sum(env1.get(x) != env2.get(x) for x in env1.keys() | env2.keys())
+    undo_log: list[tuple[str, int | None, str, int | None]] = []
+    stack: list[tuple[Term, Term, int, int]] = [(t1, t2, depth, _COMPARE)]
+    try:
+        while stack:
+            t1, t2, depth, action = stack.pop()
+            if action == _ENTER:
+                x1, x2 = t1.name, t2.name
+                undo_log.append((x1, env1.get(x1), x2, env2.get(x2)))
+                differ += _rebind(env1, env2, x1, depth, x2, depth)
+                continue
+            if action == _LEAVE:
+                differ += _rebind(env1, env2, *undo_log.pop())
+                continue
+            if differ == 0:
+                if t1 is t2:
+                    continue
+                # 環境が同じなら、自由変数も同じものを指すので、Shapeが同じならα同値
+                s1 = t1._shape
+                if s1 is not None and s1 is t2._shape:
+                    continue
+            if type(t1) != type(t2):
                 return False
-        return True
 
-    raise AlphaEqvException(f"Error at alpha_with_eqv: unexpected term: {t1,t2}")
+            if isinstance(t1, VarTerm) and isinstance(t2, VarTerm):
+                depth1 = env1.get(t1.name)
+                depth2 = env2.get(t2.name)
+                match (depth1, depth2):
+                    case (None, None):
+                        # 自由変数同士は名前で比較
+                        if t1.name != t2.name:
+                            return False
+                    case (None, _):
+                        return False
+                    case (_, None):
+                        return False
+                    case (d1, d2):
+                        # 束縛変数同士はde Bruijnで比較
+                        if d1 != d2:
+                            return False
+            elif (isinstance(t1, LambdaTerm) and isinstance(t2, LambdaTerm)) or (
+                isinstance(t1, PiTerm) and isinstance(t2, PiTerm)
+            ):
+                # $x:(M).(N)のMを先に検査する
+                stack.append((t1, t2, depth, _LEAVE))
+                stack.append((t1.t2, t2.t2, depth + 1, _COMPARE))
+                stack.append((t1, t2, depth, _ENTER))
+                stack.append((t1.t1, t2.t1, depth, _COMPARE))
+            elif (isinstance(t1, StarTerm) and isinstance(t2, StarTerm)) or (
+                isinstance(t1, SortTerm) and isinstance(t2, SortTerm)
+            ):
+                pass
+            elif isinstance(t1, AppTerm) and isinstance(t2, AppTerm):
+                stack.append((t1.t2, t2.t2, depth, _COMPARE))
+                stack.append((t1.t1, t2.t1, depth, _COMPARE))
+            elif isinstance(t1, ConstTerm) and isinstance(t2, ConstTerm):
+                if t1.op != t2.op or len(t1.children) != len(t2.children):
+                    return False
+                for tt1, tt2 in reversed(list(zip(t1.children, t2.children))):
+                    stack.append((tt1, tt2, depth, _COMPARE))
+            else:
+                raise AlphaEqvException(
+                    f"Error at alpha_with_eqv: unexpected term: {t1,t2}"
+                )
+        return True
+    finally:
+        # 本体の途中で抜けたときは、残っている束縛を内側から戻す
+        while undo_log:
+            _rebind(env1, env2, *undo_log.pop())
+
+
+def _rebind(
+    env1: dict[str, int],
+    env2: dict[str, int],
+    x1: str,
+    d1: int | None,
+    x2: str,
+    d2: int | None,
+) -> int:
+    # env1のx1をd1に、env2のx2をd2にする（Noneなら束縛を消す）。
+    # 二つの環境で束縛が異なる名前の数の増減を返す
+    before = env1.get(x1) != env2.get(x1)
+    if x1 != x2:
+        before += env1.get(x2) != env2.get(x2)
+    if d1 is None:
+        env1.pop(x1, None)
+    else:
+        env1[x1] = d1
+    if d2 is None:
+        env2.pop(x2, None)
+    else:
+        env2[x2] = d2
+    after = env1.get(x1) != env2.get(x1)
+    if x1 != x2:
+        after += env1.get(x2) != env2.get(x2)
+    return after - before
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+# pvector.py
+# 追記のみを許す永続ベクタ（PVector）を定義する
+
+from typing import Generic, Iterable, Iterator, TypeVar, overload
+
+T = TypeVar("T")
+
+
+class PVector(Generic[T]):
+    """
+    追記のみを許す永続ベクタ。
+
+    複数のPVectorが一つの下敷きのリスト（store）を共有し、各PVectorはその先頭size個を見る。
+    storeの末尾を見ているPVectorへのappendはstoreを破壊的に伸ばすだけなのでO(1)で済む。
+    古い版へのappend（分岐）のときだけ先頭size個をコピーする。
+    どの版から見ても中身は変わらないので、値として扱ってよい。
+    """
+
+    __slots__ = ("_store", "_size")
+
+    def __init__(self, items: Iterable[T] = ()):
+        self._store: list[T] = list(items)
+        self._size = len(self._store)
+
+    @classmethod
+    def _view(cls, store: list[T], size: int) -> "PVector[T]":
+        v = cls.__new__(cls)
+        v._store = store
+        v._size = size
+        return v
+
+    def append(self, x: T) -> "PVector[T]":
+        if self._size == len(self._store):
+            store = self._store
+        else:
+            store = self._store[: self._size]
+        store.append(x)
+        return self._view(store, self._size + 1)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @overload
+    def __getitem__(self, i: int) -> T:
+        ...
+
+    @overload
+    def __getitem__(self, i: slice) -> list[T]:
+        ...
+
+    def __getitem__(self, i: int | slice) -> T | list[T]:
+        if isinstance(i, slice):
+            return self._store[: self._size][i]
+        if i < 0:
+            i += self._size
+        if not 0 <= i < self._size:
+            raise IndexError("PVector index out of range")
+        return self._store[i]
+
+    def __iter__(self) -> Iterator[T]:
+        store = self._store
+        for i in range(self._size):
+            yield store[i]
+
+    def __eq__(self, that: object) -> bool:
+        if self is that:
+            return True
+        if not isinstance(that, PVector) or len(self) != len(that):
+            return False
+        if self._store is that._store:
+            return True
+        return all(a == b for a, b in zip(self, that))
+
+    def __repr__(self) -> str:
+        return f"PVector({list(self)})"
+
+    def to_list(self) -> list[T]:
+        return self._store[: self._size]
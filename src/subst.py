@@ -1,5 +1,4 @@
-import functools
-
+import nameless
 from fresh_name import Fresh
 from parse import (
     AppTerm,
@@ -13,77 +12,205 @@ from parse import (
     VarTerm,
 )
 
+# 代入の実装（エンジン）
+#   named:    名前つきの項の上で、束縛子をくぐるたびにフレッシュな名前に付け替えながら代入する
+#   nameless: 束縛変数をde Bruijn indexで表した項（nameless.py）に変換して代入する
+ENGINES = ["named", "nameless"]
+ENGINE = "named"
+
+
+class EngineError(Exception):
+    pass
+
+
+def set_engine(engine: str):
+    global ENGINE
+    if engine not in ENGINES:
+        raise EngineError(f"unknown engine: {engine}")
+    ENGINE = engine
+
 
 def subst(t1: Term, t2: Term, name: str) -> Term:
     # t1[name !--> t2]
-    if isinstance(t1, VarTerm):
-        if t1.name == name:
-            return t2
-        else:
-            return t1
-    elif isinstance(t1, LambdaTerm):
-        _t11 = subst(t1.t1, t2, name)
-        if t1.name == name:
-            return LambdaTerm(_t11, t1.t2, name)
-        else:
-            fresh_name = Fresh.fresh()
-            t12 = rename(t1.t2, t1.name, fresh_name)
-            _t12 = subst(t12, t2, name)
-            return LambdaTerm(_t11, _t12, fresh_name)
-    elif isinstance(t1, PiTerm):
-        _t11 = subst(t1.t1, t2, name)
-        if t1.name == name:
-            return PiTerm(_t11, t1.t2, name)
+    if ENGINE == "nameless":
+        return nameless.subst(t1, t2, name)
+    return subst_named(t1, t2, name)
+
+
+def subst_named(t1: Term, t2: Term, name: str) -> Term:
+    # 束縛子をくぐるたびに、束縛変数をフレッシュな名前に付け替えてから本体に代入する。
+    # 深い項でも再帰しないように、明示的なスタックで帰りがけ順にたどる。
+    # スタックの各要素は（部分項, 段階, 付け替えた名前）。段階0で部分項を積み、
+    # 段階1（束縛子の型を終えた）で本体を付け替え、最後の段階で作り終えた部分項から組み立てる
+    done: list[Term] = []
+    stack: list[tuple[Term, int, str]] = [(t1, 0, "")]
+    while stack:
+        t, stage, fresh_name = stack.pop()
+        if isinstance(t, VarTerm):
+            done.append(t2 if t.name == name else t)
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            if stage == 0:
+                stack.append((t, 1, ""))
+                stack.append((t.t1, 0, ""))
+            elif stage == 1:
+                if t.name == name:
+                    done.append(type(t)(done.pop(), t.t2, name))
+                else:
+                    fresh_name = Fresh.fresh()
+                    stack.append((t, 2, fresh_name))
+                    stack.append((rename(t.t2, t.name, fresh_name), 0, ""))
+            else:
+                _t12 = done.pop()
+                _t11 = done.pop()
+                done.append(type(t)(_t11, _t12, fresh_name))
+        elif isinstance(t, AppTerm) or isinstance(t, ConstTerm):
+            if stage == 0:
+                stack.append((t, 1, ""))
+                stack += [(tt, 0, "") for tt in reversed(subterms(t))]
+            else:
+                done.append(rebuild(t, done))
         else:
-            fresh_name = Fresh.fresh()
-            t12 = rename(t1.t2, t1.name, fresh_name)
-            _t12 = subst(t12, t2, name)
-            return PiTerm(_t11, _t12, fresh_name)
-    elif isinstance(t1, AppTerm):
-        return AppTerm(subst(t1.t1, t2, name), subst(t1.t2, t2, name))
-    elif isinstance(t1, ConstTerm):
-        return ConstTerm(t1.op, list(map(lambda tt: subst(tt, t2, name), t1.children)))
-    return t1
+            done.append(t)
+    return done[-1]
+
+
+def subterms(t: Term) -> list[Term]:
+    # 適用と定数の部分項
+    if isinstance(t, AppTerm):
+        return [t.t1, t.t2]
+    elif isinstance(t, ConstTerm):
+        return list(t.children)
+    raise UnExpectedTermError(t)
+
+
+def rebuild(t: Term, done: list[Term]) -> Term:
+    # doneの末尾に作り終えた部分項を取り出して、tと同じ形の項を組み立てる。
+    # 部分項がどれも変わっていなければt自身を返す
+    k = 2 if isinstance(t, AppTerm) else len(t.children)
+    parts = done[len(done) - k :]
+    del done[len(done) - k :]
+    if all(p is q for p, q in zip(parts, subterms(t))):
+        return t
+    if isinstance(t, AppTerm):
+        return AppTerm(parts[0], parts[1])
+    return ConstTerm(t.op, parts)
 
 
 def subst_all(t: Term, names: list[str], terms: list[Term]) -> Term:
-    tt = t
-    freshes: list[str] = []
-    for i in range(len(names)):
-        fresh = Fresh.fresh()
-        freshes.append(fresh)
-        tt = rename(tt, names[i], fresh)
-    return functools.reduce(lambda t, b: subst(t, b[1], b[0]), zip(freshes, terms), tt)
+    # t[names[0] !--> terms[0], ..., names[k-1] !--> terms[k-1]]（同時代入）
+    return subst_many(t, dict(zip(names, terms)))
 
 
-def rename(t: Term, frm: str, to: str) -> Term:
-    if isinstance(t, VarTerm):
-        if t.name == frm:
-            return VarTerm(to)
-        else:
-            return t
-    elif isinstance(t, LambdaTerm):
-        _t1 = rename(t.t1, frm, to)
-        if t.name == frm:
-            return LambdaTerm(_t1, t.t2, t.name)
+def subst_many(t: Term, mapping: dict[str, Term]) -> Term:
+    # 変数名から項への写像mappingによる同時代入。mappingは変更しない
+    if not mapping:
+        return t
+    if ENGINE == "nameless":
+        return nameless.subst_all(t, list(mapping.keys()), list(mapping.values()))
+    fvs: set[str] = set()
+    for u in mapping.values():
+        fvs |= free_vars(u)
+    return subst_many_named(t, mapping, fvs)
+
+
+def subst_many_named(t: Term, mapping: dict[str, Term], fvs: set[str]) -> Term:
+    # 一度の走査で代入する。fvsはmappingの値の自由変数の和集合。
+    # 束縛子の名前がfvsに入っているときだけ、その束縛子をフレッシュな名前に付け替える。
+    # 付け替えはmappingに名前からフレッシュな変数への対応を足して、代入と同じ走査で行う。
+    # 変化のなかった部分項は元のオブジェクトをそのまま返す。
+    # 深い項でも再帰しないように、subst_namedと同じく明示的なスタックでたどる
+    done: list[Term] = []
+    stack: list[tuple[Term, dict[str, Term], int, str]] = [(t, mapping, 0, "")]
+    while stack:
+        t, mapping, stage, name = stack.pop()
+        if isinstance(t, VarTerm):
+            done.append(mapping.get(t.name, t))
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            if stage == 0:
+                stack.append((t, mapping, 1, ""))
+                stack.append((t.t1, mapping, 0, ""))
+            elif stage == 1:
+                name = t.name
+                inner = mapping
+                if name in inner:
+                    inner = {x: u for x, u in inner.items() if x != name}
+                if inner and name in fvs:
+                    name = Fresh.fresh()
+                    inner = {**inner, t.name: VarTerm(name)}
+                stack.append((t, mapping, 2, name))
+                if inner:
+                    stack.append((t.t2, inner, 0, ""))
+                else:
+                    done.append(t.t2)
+            else:
+                t2 = done.pop()
+                t1 = done.pop()
+                if t1 is t.t1 and t2 is t.t2 and name == t.name:
+                    done.append(t)
+                else:
+                    done.append(type(t)(t1, t2, name))
+        elif isinstance(t, AppTerm) or isinstance(t, ConstTerm):
+            if stage == 0:
+                stack.append((t, mapping, 1, ""))
+                stack += [(tt, mapping, 0, "") for tt in reversed(subterms(t))]
+            else:
+                done.append(rebuild(t, done))
+        elif isinstance(t, SortTerm) or isinstance(t, StarTerm):
+            done.append(t)
         else:
-            _t2 = rename(t.t2, frm, to)
-            return LambdaTerm(_t1, _t2, t.name)
-    elif isinstance(t, PiTerm):
-        _t1 = rename(t.t1, frm, to)
-        if t.name == frm:
-            return PiTerm(_t1, t.t2, t.name)
+            raise UnExpectedTermError(t)
+    return done[-1]
+
+
+def free_vars(t: Term) -> set[str]:
+    names: set[str] = set()
+    stack: list[tuple[Term, frozenset[str]]] = [(t, frozenset())]
+    while stack:
+        t, bound = stack.pop()
+        if isinstance(t, VarTerm):
+            if t.name not in bound:
+                names.add(t.name)
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            stack.append((t.t1, bound))
+            stack.append((t.t2, bound | {t.name}))
+        elif isinstance(t, AppTerm):
+            stack.append((t.t1, bound))
+            stack.append((t.t2, bound))
+        elif isinstance(t, ConstTerm):
+            stack.extend((tt, bound) for tt in t.children)
+    return names
+
+
+def rename(t: Term, frm: str, to: str) -> Term:
+    # 自由に現れるfrmをtoに付け替える。明示的なスタックで帰りがけ順にたどる
+    done: list[Term] = []
+    stack: list[tuple[Term, bool]] = [(t, False)]
+    while stack:
+        t, built = stack.pop()
+        if isinstance(t, VarTerm):
+            done.append(VarTerm(to) if t.name == frm else t)
+        elif isinstance(t, LambdaTerm) or isinstance(t, PiTerm):
+            if built:
+                # 束縛変数がfrmなら、本体には自由に現れないのでそのまま
+                _t2 = t.t2 if t.name == frm else done.pop()
+                _t1 = done.pop()
+                done.append(type(t)(_t1, _t2, t.name))
+            else:
+                stack.append((t, True))
+                if t.name != frm:
+                    stack.append((t.t2, False))
+                stack.append((t.t1, False))
+        elif isinstance(t, AppTerm) or isinstance(t, ConstTerm):
+            if built:
+                done.append(rebuild(t, done))
+            else:
+                stack.append((t, True))
+                stack += [(tt, False) for tt in reversed(subterms(t))]
+        elif isinstance(t, SortTerm) or isinstance(t, StarTerm):
+            done.append(t)
         else:
-            _t2 = rename(t.t2, frm, to)
-            return PiTerm(_t1, _t2, t.name)
-    elif isinstance(t, AppTerm):
-        return AppTerm(rename(t.t1, frm, to), rename(t.t2, frm, to))
-    elif isinstance(t, ConstTerm):
-        return ConstTerm(t.op, list(map(lambda tt: rename(tt, frm, to), t.children)))
-    elif isinstance(t, SortTerm) or isinstance(t, StarTerm):
-        return t
-    else:
-        raise UnExpectedTermError(t)
+            raise UnExpectedTermError(t)
+    return done[-1]
 
 
 if __name__ == "__main__":
@@ -1,26 +1,50 @@
 if __name__ == "__main__":
     import argparse
+    import sys
 
-    from check import Judgement, check
+    from check import (
+        Book,
+        add_common_arguments,
+        check_book,
+        check_segments,
+        print_stats,
+        set_common_options,
+    )
+    from cache import ResultCache
     from derive import derive_lines
     import logging
     logging.basicConfig(filename="test.log", encoding="utf-8", level=logging.DEBUG)
 
     apaser = argparse.ArgumentParser(prog="test derive and check")
     apaser.add_argument("filename")
+    apaser.add_argument(
+        "--cache",
+        metavar="DIRECTORY",
+        help="導出した断片と検査に通った区間をDIRECTORYに記録し、変わった部分だけを処理し直す",
+    )
+    add_common_arguments(apaser)
     args = apaser.parse_args()
     filename = args.filename
+    set_common_options(args)
 
     with open(filename, "r") as f:
         lines = f.readlines()
-    instructions = derive_lines(lines)
-    book: list[Judgement] = []
+    cache = None if args.cache is None else ResultCache(args.cache)
+    instructions = derive_lines(lines, cache=cache)
+    book: Book = Book()
     try:
-        for inst in instructions:
-            book = check(inst, book)
+        if cache is not None:
+            book = check_segments(list(instructions), cache=cache)
+        else:
+            for inst in instructions:
+                book = check_book(inst, book)
     except Exception as e:
         for inst in instructions:
             print(inst)
         for i, judgement in enumerate(book):
             print(i, judgement)
         raise e
+    if args.stats:
+        print_stats()
+        if cache is not None:
+            print(cache, file=sys.stderr)
@@ -0,0 +1,50 @@
+# trampoline.py
+# 再帰的な計算を、Pythonの再帰の深さの上限に当たらずに実行する
+#
+# 再帰呼び出しの代わりに、部分計算をジェネレータとしてyieldするように書いた関数を、
+# 明示的なスタックで実行する。
+#
+#   def depth(t):
+#       if isinstance(t, AppTerm):
+#           return 1 + max((yield depth(t.t1)), (yield depth(t.t2)))
+#       return 0
+#       yield  # ジェネレータにするため
+#
+#   run(depth(t))
+#
+# yieldした部分計算の結果はyield式の値になり、部分計算で起きた例外はyield式から送出される。
+# したがって、再帰呼び出しと同じ順序で計算が進み、同じ結果になる。
+
+from typing import Any, Generator, TypeVar
+
+T = TypeVar("T")
+
+Step = Generator[Any, Any, T]
+
+
+def run(root: Step[T]) -> T:
+    stack: list[Step[Any]] = [root]
+    value: Any = None
+    error: BaseException | None = None
+    while True:
+        top = stack[-1]
+        try:
+            if error is None:
+                sub = top.send(value)
+            else:
+                e, error = error, None
+                sub = top.throw(e)
+        except StopIteration as stop:
+            stack.pop()
+            if not stack:
+                return stop.value
+            value = stop.value
+            continue
+        except BaseException as e:
+            stack.pop()
+            if not stack:
+                raise
+            error = e
+            continue
+        stack.append(sub)
+        value = None